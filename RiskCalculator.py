@@ -12,11 +12,25 @@ via questionnaire. The calculated risks are visualized as bar charts and percent
 
 import tkinter as tk
 from tkinter import ttk
+from tkinter import filedialog
+import bisect
+import hashlib
 import json
+import os
+import sys
+import threading
+import unicodedata
 import requests
+import numpy as np
+from concurrent.futures import Future
 from pprint import pprint
-from datetime import date, datetime
+from urllib.parse import quote
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
 from math import exp
+from risk_scoring import (
+    normalizeValues, validateInputs, STROKE_MODEL, CAD_MODEL, calculateRiskArrays, openCohort, validateCohort,
+    scoreCohort, AGE_BANDS, RISK_BINS, ageBandName, PopulationSketch, sketchCohort, barCoords, histogramLayout)
 
 user = {
     'Name' : '',
@@ -42,29 +56,110 @@ result = {
 
 patient_ids = set()
 
+all_patients = []
+
+# The bundle entries of the current patient, used for the risk trajectory
+patient_data = []
+
+# LOINC codes of the observations used in the risk calculation, keyed by the code text
+OBSERVATION_CODES = {
+    'Systolic blood pressure': '8480-6',
+    'Cholest SerPl-mCnc': '2093-3',
+    'HDLc SerPl-mCnc': '2085-9'
+}
+
+# Search parameter value matching all the observations used in the risk calculation
+LOINC_SEARCH = ','.join('http://loinc.org|' + code for code in OBSERVATION_CODES.values())
+
 class SimpleFHIRClient(object):
     """
     Retrieves patient data from the DHIR database and processes it into json format
     """
-    def __init__(self, server_url, server_user, server_password, debug=False):
+    def __init__(self, server_url, server_user, server_password, debug=False, recorder=None, pool_size=10,
+                 auth=None):
         self.debug = debug
         self.server_url = server_url
         self.server_user = server_user
         self.server_password = server_password
+        # Any requests authentication, e.g. SMARTBackendAuth of smart_auth.py. The default is basic auth.
+        self.auth = auth if auth is not None else (server_user, server_password)
+        # Object with a record(requesturl, result) method that gets every response, see fhir_replay.py
+        self.recorder = recorder
+
+        # The connections to the server are kept open and reused between the requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def getAllPatients(self):
         requesturl = self.server_url + "/Patient?_format=json"
-        entries = self._get_json(requesturl)["entry"]
-        return [entry["resource"] for entry in entries]
+        resources = []
+        while requesturl:
+            bundle = self._get_json(requesturl)
+            resources += [entry["resource"] for entry in bundle.get("entry", [])]
+            requesturl = next((link["url"] for link in bundle.get("link", [])
+                               if link.get("relation") == "next"), None)
+        return resources
+
+    def getPatient(self, patient_id):
+        requesturl = self.server_url + "/Patient/" + patient_id + "?_format=json"
+        return self._get_json(requesturl)
+
+    def getObservationHistory(self, since):
+        """
+        Returns the observations created or changed after the given instant, following the paging
+        links of the history bundle, and the server time of the request to use as the next since.
+        The time is taken from the server, as the local clock may not agree with it.
+        """
+        requesturl = self.server_url + "/Observation/_history?_since=" + quote(since) + "&_format=json"
+        headers = {}
+        server_time = None
+        resources = []
+        while requesturl:
+            bundle = self._get_json(requesturl, headers)
+            if server_time is None:
+                server_time = bundle.get("meta", {}).get("lastUpdated") or serverDate(headers.get("Date"))
+            resources += [entry["resource"] for entry in bundle.get("entry", []) if "resource" in entry]
+            requesturl = next((link["url"] for link in bundle.get("link", [])
+                               if link.get("relation") == "next"), None)
+        return resources, server_time
+
+    def getRiskObservations(self, patient_id):
+        """
+        Returns the bundle entries of the observations used in the risk calculation, newest first
+        """
+        requesturl = self.server_url + "/Observation?patient=" + patient_id + "&code=" + \
+            quote(LOINC_SEARCH, safe=',') + "&_sort=-date&_format=json"
+        entries = []
+        while requesturl:
+            bundle = self._get_json(requesturl)
+            entries += bundle.get("entry", [])
+            requesturl = next((link["url"] for link in bundle.get("link", [])
+                               if link.get("relation") == "next"), None)
+        return entries
 
     def getAllDataForPatient(self, patient_id):
         requesturl = self.server_url + "/Patient/" + \
             patient_id + "$everything?_format=json"
-        return self._get_json(requesturl)["entry"]
+        return self._get_json(requesturl).get("entry", [])
+
+    def _get_json(self, requesturl, response_headers=None):
+        response = self.session.get(requesturl, auth=self.auth)
+        response.raise_for_status()
+        if response_headers is not None:
+            response_headers.update(response.headers)
+        result = response.json()
+        if self.debug:
+            pprint(result)
+        if self.recorder is not None:
+            self.recorder.record(requesturl, result)
+        return result
 
-    def _get_json(self, requesturl):
-        response = requests.get(requesturl,
-                                auth=(self.server_user, self.server_password))
+    def _post_json(self, requesturl, data):
+        response = self.session.post(requesturl, json=data,
+                                     headers={"Content-Type": "application/fhir+json"},
+                                     auth=self.auth)
         response.raise_for_status()
         result = response.json()
         if self.debug:
@@ -72,12 +167,206 @@ class SimpleFHIRClient(object):
         return result
 
 
+def serverDate(header):
+    """
+    Convert an HTTP Date header to a FHIR instant, None if it is missing or not valid
+    """
+    try:
+        return parsedate_to_datetime(header).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    except (TypeError, ValueError):
+        return None
+
+
+class FHIRBatchCoalescer(object):
+    """
+    Collects the reads of concurrent callers for a short window (or up to max_requests reads)
+    and sends them to the server as one FHIR batch Bundle. The responses are split back to the callers.
+    """
+    def __init__(self, fhir_client, window=0.01, max_requests=50):
+        self.client = fhir_client
+        self.window = window
+        self.max_requests = max_requests
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def submit(self, relative_url):
+        """
+        Queue a read such as 'Patient/123' and return a Future of the resource
+        """
+        future = Future()
+        batch = None
+        with self.lock:
+            # callers asking for the same url share one entry of the batch
+            self.pending.setdefault(relative_url, []).append(future)
+            if len(self.pending) >= self.max_requests:
+                batch = self._take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if batch:
+            self._send(batch)
+        return future
+
+    def read(self, relative_url):
+        """
+        Queue a read and wait for its resource
+        """
+        return self.submit(relative_url).result()
+
+    def flush(self):
+        """
+        Send the pending reads without waiting for the window to end
+        """
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _take(self):
+        batch = self.pending
+        self.pending = {}
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def _send(self, batch):
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{'request': {'method': 'GET', 'url': url}} for url in batch]
+        }
+        try:
+            entries = self.client._post_json(self.client.server_url, bundle).get('entry', [])
+        except Exception as error:
+            for futures in batch.values():
+                for future in futures:
+                    future.set_exception(error)
+            return
+
+        for i, (url, futures) in enumerate(batch.items()):
+            entry = entries[i] if i < len(entries) else {}
+            status = entry.get('response', {}).get('status', 'no response')
+            for future in futures:
+                if status.startswith('2'):
+                    future.set_result(entry.get('resource'))
+                else:
+                    future.set_exception(requests.HTTPError('{} for batch entry {}'.format(status, url)))
+
+    def getPatient(self, patient_id):
+        return self.read('Patient/' + patient_id)
+
+    def searchObservations(self, patient_id, code=None):
+        query = 'Observation?patient=' + patient_id
+        if code is not None:
+            query += '&code=' + code
+        return self.read(query).get('entry', [])
+
+    def getAllDataForPatient(self, patient_id):
+        return self.read('Patient/' + patient_id + '/$everything').get('entry', [])
+
+
+RISK_ASSESSMENT_SYSTEM = 'urn:finriski:risk-assessment'
+
+
+def riskAssessment(patient_id, risks, identifier):
+    """
+    Build a FHIR RiskAssessment resource from the risks of a patient
+    """
+    return {
+        'resourceType': 'RiskAssessment',
+        'identifier': [{'system': RISK_ASSESSMENT_SYSTEM, 'value': identifier}],
+        'status': 'final',
+        'subject': {'reference': 'Patient/' + patient_id},
+        'occurrenceDateTime': datetime.now().astimezone().isoformat(timespec='seconds'),
+        'method': {'text': 'FINRISKI'},
+        'prediction': [{'outcome': {'text': key}, 'probabilityDecimal': round(float(risks[key]) / 100, 3)}
+                       for key in ('Heart attack', 'Stroke', 'Both')]
+    }
+
+
+class RiskAssessmentWriter(object):
+    """
+    Writes the calculated risks back to the FHIR server as RiskAssessment resources,
+    grouped into transaction Bundles of batch_size resources. The writes are conditional, so
+    rerunning the same calculation does not create duplicates: by default each patient has one
+    RiskAssessment that is updated, with history=True a new one is created only when the risks change.
+    """
+    def __init__(self, fhir_client, batch_size=100, history=False):
+        self.client = fhir_client
+        self.batch_size = batch_size
+        self.history = history
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, patient_id, risks):
+        """
+        Queue the risks of a patient, the queue is sent when batch_size is reached
+        """
+        if self.history:
+            # rounded like the shown risks, so the float32 risks of batch runs give the same identifier
+            values = json.dumps([patient_id] + [round(float(risks[key]), 1) for key in ('Heart attack', 'Stroke', 'Both')])
+            identifier = patient_id + '-' + hashlib.sha1(values.encode('utf-8')).hexdigest()[:12]
+            request = {'method': 'POST', 'url': 'RiskAssessment',
+                       'ifNoneExist': 'identifier=' + RISK_ASSESSMENT_SYSTEM + '|' + identifier}
+        else:
+            identifier = patient_id
+            request = {'method': 'PUT',
+                       'url': 'RiskAssessment?identifier=' + RISK_ASSESSMENT_SYSTEM + '|' + identifier}
+
+        entry = {'resource': riskAssessment(patient_id, risks, identifier), 'request': request}
+        with self.lock:
+            self.entries.append(entry)
+            full = len(self.entries) >= self.batch_size
+        if full:
+            self.flush()
+
+    def addAll(self, patient_ids, risks):
+        """
+        Queue the risks of a batch run, risks is a dict of arrays like the one from scoreCohort
+        """
+        for i, patient_id in enumerate(patient_ids):
+            if isinstance(patient_id, bytes):
+                patient_id = patient_id.decode('utf-8')
+            self.add(patient_id, {key: values[i] for key, values in risks.items()})
+
+    def flush(self):
+        """
+        Send the queued RiskAssessments as transaction Bundles. If a Bundle fails, it and the
+        Bundles after it are put back to the queue for the next flush and the error is raised.
+        """
+        with self.lock:
+            entries = self.entries
+            self.entries = []
+
+        for start in range(0, len(entries), self.batch_size):
+            bundle = {
+                'resourceType': 'Bundle',
+                'type': 'transaction',
+                'entry': entries[start:start + self.batch_size]
+            }
+            try:
+                self.client._post_json(self.client.server_url, bundle)
+            except requests.RequestException:
+                with self.lock:
+                    self.entries[:0] = entries[start:]
+                raise
+
+
 client = SimpleFHIRClient(
-    server_url="",
-    server_user="",
-    server_password="")
+    server_url=os.environ.get("FHIR_SERVER_URL", ""),
+    server_user=os.environ.get("FHIR_SERVER_USER", ""),
+    server_password=os.environ.get("FHIR_SERVER_PASSWORD", ""))
+
+# Set to a RiskAssessmentWriter to save the calculated risks to the FHIR server,
+# the GUI does it when the FHIR_WRITE_BACK environment variable is set
+risk_writer = None
 
-all_patients = client.getAllPatients()
+# The PopulationSketch shown in the population view
+population = None
 
 
 def getBorn(id):
@@ -94,14 +383,115 @@ def definePatientIds():
     """
     Defines the patient ids into a global set
     """
+    global all_patients
     all_patients = client.getAllPatients()
 
     for patient_record in all_patients:
         patient_ids.add(patient_record["id"])
 
+    patient_index.build((patient_record["id"], formatName(patient_record))
+                        for patient_record in all_patients)
+
     pprint(patient_ids)
 
 
+def formatName(patient_record):
+    """
+    Format the name of the patient resource as 'given family'
+    """
+    try:
+        name = patient_record["name"][0]
+        family = name["family"]
+        # family is a list in DSTU2 and a string in later FHIR versions
+        if isinstance(family, list):
+            family = family[0]
+        return name["given"][0] + ' ' + family
+    except (KeyError, IndexError):
+        return ''
+
+
+class PatientPrefixIndex(object):
+    """
+    Sorted array of the normalized patient ids and names, searched by prefix with bisect.
+    Each name is indexed from the start of every word, so 'virt' finds 'Anna Virtanen'.
+    """
+    def __init__(self):
+        self.keys = []
+        self.names = {}
+
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+        return ' '.join(text.casefold().split())
+
+    def _keys(self, patient_id, name):
+        keys = {self.normalize(patient_id)}
+        words = self.normalize(name).split()
+        for i in range(len(words)):
+            keys.add(' '.join(words[i:]))
+        return [(key, patient_id) for key in keys if key]
+
+    def build(self, patients):
+        """
+        Index many (id, name) pairs at once. The old keys of the patients that are already indexed
+        are dropped before sorting, as bisect cannot find them from a partly sorted array.
+        """
+        added = {}
+        for patient_id, name in patients:
+            added[patient_id] = name
+
+        stale = set()
+        for patient_id in added:
+            if patient_id in self.names:
+                stale.update(self._keys(patient_id, self.names[patient_id]))
+        if stale:
+            self.keys = [key for key in self.keys if key not in stale]
+
+        for patient_id, name in added.items():
+            self.names[patient_id] = name
+            self.keys.extend(self._keys(patient_id, name))
+        self.keys.sort()
+
+    def add(self, patient_id, name=''):
+        """
+        Add or update one patient, keeping the array sorted
+        """
+        if patient_id in self.names:
+            self.remove(patient_id)
+        self.names[patient_id] = name
+        for key in self._keys(patient_id, name):
+            bisect.insort(self.keys, key)
+
+    def remove(self, patient_id):
+        name = self.names.pop(patient_id, None)
+        if name is None:
+            return
+        for key in self._keys(patient_id, name):
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def search(self, prefix, limit=10):
+        """
+        Ids of the patients whose id or some name word starts with the prefix
+        """
+        prefix = self.normalize(prefix)
+        found = []
+        if not prefix:
+            return found
+
+        i = bisect.bisect_left(self.keys, (prefix,))
+        while i < len(self.keys) and self.keys[i][0].startswith(prefix) and len(found) < limit:
+            if self.keys[i][1] not in found:
+                found.append(self.keys[i][1])
+            i += 1
+        return found
+
+
+patient_index = PatientPrefixIndex()
+
+
 def getGender(id):
     """
     Get the gender of the patient
@@ -120,9 +510,7 @@ def getName(id):
     all_patients = client.getAllPatients()
     for patient_record in all_patients:
         if  patient_record["id"] == id:
-            patient_name_given = patient_record["name"][0]["given"][0]
-            patient_name_family = patient_record["name"][0]["family"][0]
-            patient_name = patient_name_given + ' ' + patient_name_family
+            patient_name = formatName(patient_record)
     return patient_name
 
 
@@ -130,9 +518,11 @@ def updatePatient(patient_id):
     """
     Updating the patient struct with fetching the values from FHIR
     """
-    BP = getBloodPressure(patient_id)
-    HDL = getHDL(patient_id)
-    cholest = getCholesterolValue(patient_id)
+    all_data = client.getAllDataForPatient(patient_id)
+    patient_data[:] = all_data
+    BP = getBloodPressure(patient_id, all_data)
+    HDL = getHDL(patient_id, all_data)
+    cholest = getCholesterolValue(patient_id, all_data)
     born = getBorn(patient_id)
     age = getAge(born)
     gender = getGender(patient_id)
@@ -193,13 +583,65 @@ def updateResult(patient_id):
     """
     Updating the result struct with fetching the values from the risk calculation functions
     """
-    HT = calculateCAD(patient['Blood pressure'], patient['HDL'], patient['Cholesterol'], patient['Age'], patient['Smoke'], patient['Diabetes'], patient['Gender'])
-    stroke = calculateStroke(patient['Blood pressure'], patient['HDL'], patient['Age'], patient['Smoke'], patient['Diabetes'], patient['Gender'])
+    risks = calculateRisks(patient['Blood pressure'], patient['HDL'], patient['Cholesterol'], patient['Age'], patient['Smoke'], patient['Diabetes'], patient['Gender'])
+    result.update(risks)
+
+    if risk_writer is not None:
+        # the results are shown even if the server is not reachable, the write is retried on the next flush
+        try:
+            risk_writer.add(patient_id, risks)
+            risk_writer.flush()
+        except requests.RequestException as error:
+            print('Could not save the RiskAssessment of patient {}: {}'.format(patient_id, error))
+
+
+def scorePatientData(patient_record, all_data, smoke=0, db=0):
+    """
+    Calculating the risks straight from the patient resource and its bundle entries,
+    returns None if some of the needed values are missing
+    """
+    BP_list = getObservationQuantities(all_data, 'Systolic blood pressure')
+    CH_list = getObservationQuantities(all_data, 'Cholest SerPl-mCnc')
+    HDL_list = getObservationQuantities(all_data, 'HDLc SerPl-mCnc')
+    born = parseBirthDate(patient_record.get('birthDate'))
+    if not BP_list or not CH_list or not HDL_list or born is None:
+        return None
+
+    values = {
+        'Age': getAge(born),
+        'Blood pressure': float(normalizeValues('Blood pressure', *BP_list[0])),
+        'Cholesterol': round(float(normalizeValues('Cholesterol', *CH_list[0])), 1),
+        'HDL': round(float(normalizeValues('HDL', *HDL_list[0])), 1)
+    }
+    if validateInputs(values)['Any']:
+        return None
+
+    return calculateRisks(values['Blood pressure'], values['HDL'], values['Cholesterol'], values['Age'],
+                          smoke, db, patient_record.get('gender'))
+
+
+def calculateRisks(BP, HDL, ch, age, smoke, db, gender):
+    """
+    Calculating all the risks of a patient into a dict shaped like the result struct
+    """
+    HT = calculateCAD(BP, HDL, ch, age, smoke, db, gender)
+    stroke = calculateStroke(BP, HDL, age, smoke, db, gender)
     both = calculateBoth(stroke, HT)
 
-    result['Heart attack'] = HT
-    result['Stroke'] = stroke
-    result['Both'] = both
+    return {'Heart attack': HT, 'Stroke': stroke, 'Both': both}
+
+
+def parseBirthDate(text):
+    """
+    Parse a FHIR birth date, which can also be only a year or a year and a month. The missing parts
+    are taken from the middle of the year or the month. Returns None if the date is not valid.
+    """
+    for date_format, missing in (('%Y-%m-%d', {}), ('%Y-%m', {'day': 15}), ('%Y', {'month': 7, 'day': 1})):
+        try:
+            return datetime.strptime(text, date_format).replace(**missing)
+        except (TypeError, ValueError):
+            continue
+    return None
 
 
 def getAge(born):
@@ -211,159 +653,365 @@ def getAge(born):
     return age
 
 
-def getBloodPressure(id):
+def getObservationQuantities(all_data, code_text):
     """
-    Get systolic blood pressure from patient
+    Get the values and the UCUM units of the observations with the given code text (or its LOINC code)
+    in the order they appear in the bundle entries
     """
+    loinc = OBSERVATION_CODES.get(code_text)
+    quantities = []
 
-    BP_list = []
-    all_data = client.getAllDataForPatient(id)
-    x = range(0, len(all_data))
-
-    for i in x:
+    for entry in all_data:
         try:
-            if all_data[i]['resource']['code']:
-                if all_data[i]['resource']['code']['text'] == 'Systolic blood pressure':
-                    BP_list.append((all_data[i]['resource']['valueQuantity']['value']))
+            code = entry['resource']['code']
+            if code.get('text') == code_text or \
+                    any(coding.get('code') == loinc for coding in code.get('coding', [])):
+                quantity = entry['resource']['valueQuantity']
+                quantities.append((quantity['value'], quantity.get('code') or quantity.get('unit')))
 
         except KeyError:
             continue
 
+    return quantities
+
+
+def getObservationValues(all_data, code_text):
+    """
+    Get the values of the observations with the given code text (or its LOINC code)
+    in the order they appear in the bundle entries
+    """
+    return [value for value, unit in getObservationQuantities(all_data, code_text)]
+
+
+def formValue(value, digits=None):
+    """
+    Round a normalized value for the information form, values that could not be converted become 0
+    """
+    value = float(value)
+    if np.isnan(value):
+        return 0
+    return round(value, digits)
+
+
+def getBloodPressure(id, all_data=None):
+    """
+    Get systolic blood pressure from patient
+    """
+    if all_data is None:
+        all_data = client.getAllDataForPatient(id)
+    BP_list = getObservationQuantities(all_data, 'Systolic blood pressure')
+
     if len(BP_list) == 0:
-        BP_value = 0
+        BP_value, BP_unit = 0, None
 
     else:
-        BP_value = BP_list[0]
+        BP_value, BP_unit = BP_list[0]
 
-    return BP_value
+    return formValue(normalizeValues('Blood pressure', BP_value, BP_unit))
 
 
-def getCholesterolValue(id):
+def getCholesterolValue(id, all_data=None):
     """
     Get cholesterol value from patient
     """
-    CH_list = []
-    all_data = client.getAllDataForPatient(id)
-    x = range(0, len(all_data))
-
-    for i in x:
-        try:
-            if all_data[i]['resource']['code']:
-                if all_data[i]['resource']['code']['text'] == 'Cholest SerPl-mCnc':
-                    CH_list.append(all_data[i]['resource']['valueQuantity']['value'])
-
-        except KeyError:
-            continue
+    if all_data is None:
+        all_data = client.getAllDataForPatient(id)
+    CH_list = getObservationQuantities(all_data, 'Cholest SerPl-mCnc')
 
     if len(CH_list) == 0:
-        CH_value = 0
+        CH_value, CH_unit = 0, None
     else:
-        CH_value = CH_list[0]
+        CH_value, CH_unit = CH_list[0]
 
-    return round(CH_value * 10/386.65, 1)   # change from mmHg to mmol/L
+    return formValue(normalizeValues('Cholesterol', CH_value, CH_unit), 1)   # in mmol/L
 
 
-def getHDL(id):
+def getHDL(id, all_data=None):
     """
     Get HDL ('good cholesterol') value from the patient
     """
-    HDL_list = []
-    all_data = client.getAllDataForPatient(id)
-    x = range(0, len(all_data))
+    if all_data is None:
+        all_data = client.getAllDataForPatient(id)
+    HDL_list = getObservationQuantities(all_data, 'HDLc SerPl-mCnc')
+
+    if len(HDL_list) == 0:
+        HDL_value, HDL_unit = 0, None
+    else:
+        HDL_value, HDL_unit = HDL_list[0]
+
+    return formValue(normalizeValues('HDL', HDL_value, HDL_unit), 1)   # in mmol/L
+
+
+def getObservationSeries(all_data, code_text):
+    """
+    Get all the measurements of the observations with the given code text
+    as arrays of times, values and UCUM units, sorted by time
+    """
+    loinc = OBSERVATION_CODES.get(code_text)
+    times = []
+    values = []
+    units = []
 
-    for i in x:
+    for entry in all_data:
         try:
-            if all_data[i]['resource']['code']:
-                if all_data[i]['resource']['code']['text'] == 'HDLc SerPl-mCnc':
-                    HDL_list.append(all_data[i]['resource']['valueQuantity']['value'])
+            resource = entry['resource']
+            code = resource['code']
+            if code.get('text') == code_text or \
+                    any(coding.get('code') == loinc for coding in code.get('coding', [])):
+                measured = resource.get('effectiveDateTime') or resource['issued']
+                quantity = resource['valueQuantity']
+                values.append(quantity['value'])
+                units.append(quantity.get('code') or quantity.get('unit') or '')
+                # numpy does not parse the time zone, the local time is accurate enough here
+                times.append(measured[:19])
 
         except KeyError:
             continue
 
-    if len(HDL_list) == 0:
-        HDL_value = 0
-    else:
-        HDL_value = HDL_list[0]
+    times = np.array(times, dtype='datetime64[s]')
+    values = np.array(values, dtype=float)
+    units = np.array(units, dtype=str)
+    order = np.argsort(times, kind='stable')
+    return times[order], values[order], units[order]
 
-    return round(HDL_value * 10/386.65, 1)   # change from mmHg to mmol/L
 
-
-def results_histogram(data, canvas, width=400, height=300, bar_color="#90B2DF"):
+def getRiskTrajectory(all_data, born, gender, smoke, db, fast=False):
     """
-    Plots the histograms that visualize the risk percentages
+    Calculating the risks at every time a blood pressure or a cholesterol value was measured.
+    The latest earlier value of the other measurements is carried forward and the times before
+    all the values are known are left out. Returns a dict of arrays with 'Time' and 'Age'
+    in addition to the keys of the result struct.
+    """
+    BP_times, BP_values, BP_units = getObservationSeries(all_data, 'Systolic blood pressure')
+    CH_times, CH_values, CH_units = getObservationSeries(all_data, 'Cholest SerPl-mCnc')
+    HDL_times, HDL_values, HDL_units = getObservationSeries(all_data, 'HDLc SerPl-mCnc')
+    BP_values = normalizeValues('Blood pressure', BP_values, BP_units)
+    CH_values = normalizeValues('Cholesterol', CH_values, CH_units)
+    HDL_values = normalizeValues('HDL', HDL_values, HDL_units)
+
+    times = np.unique(np.concatenate((BP_times, CH_times, HDL_times)))
+    if len(BP_times) == 0 or len(CH_times) == 0 or len(HDL_times) == 0:
+        times = times[:0]
+
+    def carryForward(series_times, series_values):
+        index = np.searchsorted(series_times, times, side='right') - 1
+        return np.where(index >= 0, series_values[np.maximum(index, 0)], np.nan)
+
+    BP = carryForward(BP_times, BP_values)
+    cholest = np.round(carryForward(CH_times, CH_values), 1)
+    HDL = np.round(carryForward(HDL_times, HDL_values), 1)
+    known = ~validateInputs({'Blood pressure': BP, 'Cholesterol': cholest, 'HDL': HDL})['Any']
+    times, BP, cholest, HDL = times[known], BP[known], cholest[known], HDL[known]
+
+    # age in full years at each time, as in getAge
+    years = times.astype('datetime64[Y]').astype(int) + 1970
+    months = times.astype('datetime64[M]').astype(int) % 12 + 1
+    days = (times.astype('datetime64[D]') - times.astype('datetime64[M]')).astype(int) + 1
+    before_birthday = (months < born.month) | ((months == born.month) & (days < born.day))
+    age = years - born.year - before_birthday
+
+    trajectory = calculateRiskArrays(BP, HDL, cholest, age, smoke, db,
+                                     np.full(len(times), gender == 'female'), fast)
+    trajectory['Time'] = times
+    trajectory['Age'] = age
+    return trajectory
+
+
+class ScoreCache(object):
     """
-    height_in_pix = 250
-    width_in_pix = 60
-    x_start = 100
+    Thread-safe store of precomputed risk results keyed by patient id,
+    optionally persisted as a json file
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.scores = {}
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.reload()
+
+    def reload(self):
+        """
+        Read the scores written to the file by other processes, if it has changed since the last read.
+        Of two scores of the same patient the newer one is kept.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with open(self.path) as f:
+            scores = json.load(f)
+
+        with self.lock:
+            self.mtime = mtime
+            for patient_id, entry in scores.items():
+                current = self.scores.get(patient_id)
+                if current is None or current.get('Updated', '') <= entry.get('Updated', ''):
+                    self.scores[patient_id] = entry
+
+    def get(self, patient_id):
+        with self.lock:
+            return self.scores.get(patient_id)
+
+    def put(self, patient_id, risks, **extra):
+        entry = dict(risks)
+        entry.update(extra)
+        entry['Updated'] = datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            self.scores[patient_id] = entry
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.scores)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+class ScenarioEngine(object):
+    """
+    Keeps the exponents of the risk models of one patient, so that changing one value
+    only updates its own term instead of recalculating the whole model
+    """
+    # Index of the coefficient of each value in STROKE_MODEL and CAD_MODEL
+    TERMS = {'Age': 1, 'Smoke': 2, 'Cholesterol': 3, 'HDL': 4, 'Blood pressure': 5, 'Diabetes': 6}
 
-    canvas.create_line(40, 275, 400, 275)
-    canvas.create_line(40, 250, 400, 250)
-    canvas.create_line(40, 225, 400, 225)
-    canvas.create_line(40, 200, 400, 200)
-    canvas.create_line(40, 175, 400, 175)
-    canvas.create_line(40, 150, 400, 150)
-    canvas.create_line(40, 125, 400, 125)
-    canvas.create_line(40, 100, 400, 100)
-    canvas.create_line(40, 75, 400, 75)
-    canvas.create_line(40, 50, 400, 50)
-    canvas.create_line(40, 25, 400, 25)
-    canvas.create_line(50, 15, 50, 275)
+    def __init__(self, patient_struct):
+        model_gender = 'female' if patient_struct['Gender'] == 'female' else 'male'
+        self.CAD_terms = CAD_MODEL[model_gender]
+        self.stroke_terms = STROKE_MODEL[model_gender]
 
-    for key in data.keys():
-        pprint(key)
-        pprint(data[key])
+        self.base = {key: float(patient_struct[key]) for key in self.TERMS}
+        self.values = dict(self.base)
+        self.x_CAD = self.CAD_terms[0] + sum(self.CAD_terms[i] * self.values[key] for key, i in self.TERMS.items())
+        self.x_stroke = self.stroke_terms[0] + sum(self.stroke_terms[i] * self.values[key] for key, i in self.TERMS.items())
 
-        x0 = x_start
-        y0 = (250 - round(250*(data[key]/100)))+25
-        x1 = x0 + width_in_pix
-        y1 = 275
+    def set(self, key, value):
+        """
+        Change one value of the scenario
+        """
+        delta = float(value) - self.values[key]
+        self.x_CAD += self.CAD_terms[self.TERMS[key]] * delta
+        self.x_stroke += self.stroke_terms[self.TERMS[key]] * delta
+        self.values[key] = float(value)
 
-        x_start += 95
+    def risks(self):
+        """
+        The risks of the scenario as a dict shaped like the result struct
+        """
+        HT = round(100 / (1 + exp(self.x_CAD)), 1)
+        stroke = round(100 / (1 + exp(self.x_stroke)), 1)
+        return {'Heart attack': HT, 'Stroke': stroke, 'Both': calculateBoth(stroke, HT)}
 
-        pprint(y0)
-        pprint(round(250*(data[key]/100)))
+    def cohortScenario(self):
+        """
+        The changes of the scenario in the form used by scoreCohort
+        """
+        scenario = {}
+        for key in ('Blood pressure', 'Cholesterol', 'HDL'):
+            if self.values[key] != self.base[key]:
+                scenario[key] = ('add', self.values[key] - self.base[key])
+        for key in ('Smoke', 'Diabetes'):
+            if self.values[key] != self.base[key]:
+                scenario[key] = ('set', int(self.values[key]))
+        return scenario
 
-        canvas.create_rectangle(x0, y0, x1, y1, fill=bar_color)
 
+def results_histogram(data, canvas, width=400, height=300, bar_color="#90B2DF"):
+    """
+    Plots the histograms that visualize the risk percentages
+    """
+    for kind, coords, options in histogramLayout(data, bar_color):
+        getattr(canvas, 'create_' + kind)(*coords, **options)
 
-    canvas.create_text(130, 285, text="Heart attack", fill="black",
-                       font=("Helvetica", 11))
-    info_txt_1 = "{} %".format(result['Heart attack'])
-    canvas.create_text(130, 295, text=info_txt_1, fill="#4C70AB",
-                       font=("Helvetica", 11))
-    canvas.create_text(225, 285, text="Stroke", fill="black",
-                       font=("Helvetica", 11))
-    info_txt_2 = "{} %".format(result['Stroke'])
-    canvas.create_text(227, 295, text=info_txt_2, fill="#4C70AB",
-                       font=("Helvetica", 11))
-    canvas.create_text(320, 285, text="Both", fill="black",
-                       font=("Helvetica", 11))
-    info_txt_3 = "{} %".format(result['Both'])
-    canvas.create_text(323, 295, text=info_txt_3, fill="#4C70AB",
-                       font=("Helvetica", 11))
 
-    canvas.create_text(25, 25, text="100", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 50, text="90", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 75, text="80", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 100, text="70", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 125, text="60", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 150, text="50", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 175, text="40", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 200, text="30", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 225, text="20", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 250, text="10", fill="black",
-                       font=("Helvetica", 11))
-    canvas.create_text(25, 275, text="0", fill="black",
+def updateHistogram(data, canvas):
+    """
+    Moves the bars and changes the percentages of an already plotted histogram
+    """
+    for i, key in enumerate(data.keys()):
+        canvas.coords("bar{}".format(i), *barCoords(data[key], i))
+        canvas.itemconfig("value{}".format(i), text="{} %".format(data[key]))
+
+
+def trajectory_chart(trajectory, canvas, width=360, height=300):
+    """
+    Plots the risks of the trajectory as lines over time
+    """
+    colors = {'Heart attack': "#4C70AB", 'Stroke': "#90B2DF", 'Both': "black"}
+    left, right, top, bottom = 40, width - 10, 25, height - 40
+
+    times = trajectory['Time']
+    if len(times) == 0:
+        canvas.create_text(width // 2, height // 2, text="No measurement history", fill="black",
+                           font=("Helvetica", 11))
+        return
+
+    # at most one point per pixel is drawn
+    if len(times) > right - left:
+        points = np.linspace(0, len(times) - 1, right - left).astype(int)
+    else:
+        points = np.arange(len(times))
+
+    seconds = times[points].astype('int64')
+    span = max(seconds[-1] - seconds[0], 1)
+    x = left + (seconds - seconds[0]) / span * (right - left)
+    top_risk = max(10, int(np.ceil(max(trajectory[key].max() for key in colors) / 10)) * 10)
+
+    canvas.create_line(left, bottom, right, bottom)
+    canvas.create_line(left, top, left, bottom)
+    canvas.create_text(left - 15, top, text=str(top_risk), fill="black", font=("Helvetica", 11))
+    canvas.create_text(left - 15, bottom, text="0", fill="black", font=("Helvetica", 11))
+    canvas.create_text(left, bottom + 12, text=str(times[0].astype('datetime64[Y]')), fill="black",
                        font=("Helvetica", 11))
+    canvas.create_text(right, bottom + 12, text=str(times[-1].astype('datetime64[Y]')), fill="black",
+                       font=("Helvetica", 11), anchor="e")
+
+    for i, (key, color) in enumerate(colors.items()):
+        y = bottom - trajectory[key][points] / top_risk * (bottom - top)
+        coords = np.column_stack((x, y)).ravel().tolist()
+        if len(coords) == 2:
+            coords = [coords[0] - 2, coords[1], coords[0] + 2, coords[1]]
+        canvas.create_line(*coords, fill=color, width=2)
+        canvas.create_text(left + 10 + i * 100, height - 10, text=key, fill=color,
+                           font=("Helvetica", 11), anchor="w")
+
+
+def population_chart(sketch, key, risk, band, gender, canvas, width=360, height=250, bar_color="#90B2DF"):
+    """
+    Plots the risk distribution of the age band and gender, and marks the risk of the patient on it
+    """
+    left, right, top, bottom = 10, width - 10, 30, height - 40
+    counts = sketch.histogram(key, band, gender)
+
+    # the shown range covers the population and the patient, in at most 50 bars
+    nonzero = np.flatnonzero(counts)
+    last_bin = max(nonzero[-1] if len(nonzero) else 0, int(round(risk * 10)), 49)
+    bar_bins = int(np.ceil((last_bin + 1) / 50))
+    bars = np.add.reduceat(counts[:50 * bar_bins], np.arange(0, min(50 * bar_bins, RISK_BINS), bar_bins))
+    bar_width = (right - left) / len(bars)
+    scale = (bottom - top) / max(bars.max(), 1)
+
+    canvas.create_text(width // 2, 12, text=key, fill="black", font=("Helvetica", 11))
+    canvas.create_line(left, bottom, right, bottom)
+    for i, count in enumerate(bars):
+        if count:
+            canvas.create_rectangle(left + i * bar_width, bottom - count * scale,
+                                    left + (i + 1) * bar_width, bottom, fill=bar_color, outline="")
+
+    x = left + risk * 10 / bar_bins * bar_width
+    canvas.create_line(x, top, x, bottom, fill="red", width=2)
+    canvas.create_text(left, bottom + 12, text="0 %", fill="black", font=("Helvetica", 11), anchor="w")
+    canvas.create_text(right, bottom + 12, text="{} %".format(len(bars) * bar_bins / 10), fill="black",
+                       font=("Helvetica", 11), anchor="e")
+
+    info_txt = "{} %, {:.0f}th percentile, mean {:.1f} %, median {} %".format(
+        risk, sketch.percentile(key, risk, band, gender), sketch.mean(key, band, gender),
+        sketch.quantile(key, 0.5, band, gender))
+    canvas.create_text(width // 2, bottom + 28, text=info_txt, fill="#4C70AB", font=("Helvetica", 10))
 
 
 class ContainerPages (tk.Tk):
@@ -377,7 +1025,7 @@ class ContainerPages (tk.Tk):
         tk.Tk.__init__(self)
 
         # Defined size of the window
-        self.geometry("800x600")
+        self.geometry("1200x700")
 
         self.display_startpage()
         definePatientIds()
@@ -454,12 +1102,29 @@ class ContainerPages (tk.Tk):
         frame.grid(row=0, column=0, sticky="nsew")
         frame.tkraise()
 
+    def display_populationpage(self):
+        """
+        Displays the risk distributions of the population
+        """
+        frames = tk.Frame(self)
+
+        # The frames are packed within parent widget
+        frames.grid(row=1, column=0, sticky="nsew")
+        frames.grid_rowconfigure(0, weight=1)
+        frames.grid_columnconfigure(0, weight=1)
+
+        name = PopulationPage.__name__
+        frame = PopulationPage(parent=frames, controller=self)
+        self.pages[name] = frame
+
+        frame.grid(row=0, column=0, sticky="nsew")
+        frame.tkraise()
+
     def display_frame(self, name):
         page = self.pages[name]
         page.tkraise()
 
 
-
 class StartPage(tk.Frame):
     """
     Class defined for the first page, where the user logs in
@@ -542,8 +1207,6 @@ class SearchPage(tk.Frame):
     """
     Class for the search page (second window), where patient can be searched with an ID
     """
-    patient_ids = {'12345'}
-
     def __init__(self, parent, controller):
         tk.Frame.__init__(self, parent)
         self.controller = controller
@@ -591,12 +1254,44 @@ class SearchPage(tk.Frame):
         # Create entry line
         entry_id = tk.Entry(self, width=20)
         entry_id.grid(row=5, column=2, columnspan=3, padx=0, pady=5, sticky='w')
+        entry_id.bind("<KeyRelease>", lambda event: self.schedule_suggestions())
+        entry_id.bind("<Return>", lambda event: self.check_patient_id(self, patient_ids, entry_id))
+        self.entry_id = entry_id
+
+        # Create list of suggestions shown while typing the id or the name
+        self.suggestions = []
+        self.suggestions_pending = None
+        self.suggestion_list = tk.Listbox(self, width=40, height=5)
+        self.suggestion_list.grid(row=6, column=2, columnspan=3, padx=0, pady=5, sticky='w')
+        self.suggestion_list.bind("<<ListboxSelect>>", lambda event: self.select_suggestion())
 
         # Create search button
         search_btn = tk.Button(self, text="Search", width=5,
                              command=lambda: self.check_patient_id(self, patient_ids, entry_id))
         search_btn.grid(row=7, column=3, padx=5, pady=5)
 
+    def schedule_suggestions(self):
+        """
+        Update the suggestions when the typing pauses
+        """
+        if self.suggestions_pending is not None:
+            self.after_cancel(self.suggestions_pending)
+        self.suggestions_pending = self.after(150, self.show_suggestions)
+
+    def show_suggestions(self):
+        self.suggestions_pending = None
+        self.suggestions = patient_index.search(self.entry_id.get(), limit=5)
+
+        self.suggestion_list.delete(0, tk.END)
+        for patient_id in self.suggestions:
+            self.suggestion_list.insert(tk.END, patient_id + '  ' + patient_index.names.get(patient_id, ''))
+
+    def select_suggestion(self):
+        selection = self.suggestion_list.curselection()
+        if selection:
+            self.entry_id.delete(0, tk.END)
+            self.entry_id.insert(0, self.suggestions[selection[0]])
+
     def check_patient_id(self, frame, ids, value):
         entry_str = value.get()
 
@@ -606,8 +1301,7 @@ class SearchPage(tk.Frame):
 
         else:
             info_lbl = tk.Label(self, text="Wrong patient id", fg="red")
-            info_lbl.grid(row=6, column=2, padx=5, pady=5)
-
+            info_lbl.grid(row=8, column=2, padx=5, pady=5)
 
 
 class InfoPage(tk.Frame):
@@ -672,34 +1366,19 @@ class InfoPage(tk.Frame):
             diabetes_error.config(text=diabetes_text.get())
 
 
-
         #function for checking that cholesterol levels are in correct range
         def checkCholesterol():
-            HDL_float=0
-            cl_float=0
-
-            try:
-                HDL_text.set("")
-                HDL_float = float(HDL.get())
-
-            except ValueError:
-                errors.set(True)
-                HDL_text.set("Check HDL cholesterol level")
-
-            try:
-                cl_text.set("")
-                cl_float = float(cl.get())
-
-            except ValueError:
-                errors.set(True)
-                cl_text.set("Check cholesterol level")
+            HDL_text.set("")
+            cl_text.set("")
 
+            #the values have to be numbers within the limits
+            input_errors = validateInputs({'HDL': HDL.get(), 'Cholesterol': cl.get()})
 
-            if HDL_float < 0.3 or HDL_float > 5:
+            if input_errors['HDL']:
                 errors.set(True)
                 HDL_text.set("Check HDL cholesterol level")
 
-            if cl_float < 2 or cl_float > 20:
+            if input_errors['Cholesterol']:
                 errors.set(True)
                 cl_text.set("Check cholesterol level")
 
@@ -710,12 +1389,9 @@ class InfoPage(tk.Frame):
         #funktion for checking that age and name are in correct format
         def checkBasicInformation():
 
-            #check that age is number
-            try:
-                age_text.set("")
-                age_number = int(age.get())
-
-            except ValueError:
+            #check that age is a whole number within the limits
+            age_text.set("")
+            if validateInputs({'Age': age.get()})['Age']:
                 errors.set(True)
                 age_text.set("Check patient's age")
 
@@ -743,21 +1419,13 @@ class InfoPage(tk.Frame):
         #function for checking the blood pressure
         def checkBP():
 
-            systolic = 0
             bp_text.set("")
 
-            #check that the numbe is float
-            try:
-                systolic = float(bp.get())
-
-            except ValueError:
+            #check that bp is a number within the limits
+            if validateInputs({'Blood pressure': bp.get()})['Blood pressure']:
                 bp_text.set("Check blood pressure")
                 errors.set(True)
 
-            #check that bp is within the limits
-            if systolic < 80 or systolic > 240:
-                bp_text.set("Check blood pressure")
-
 
             #configure the error message
             bp_error.config(text=bp_text.get())
@@ -994,7 +1662,191 @@ class ResultPage(tk.Frame):
 
         results_histogram(result, canvas)
 
-ui = ContainerPages()
-ui.mainloop()
+        # Risk trajectory from the whole measurement history next to the bars
+        trajectory_canvas = tk.Canvas(self, width=360, height=300)
+        trajectory_canvas.grid(row=6, column=6, padx=5, pady=5, sticky='w')
+        if patient_data and patient['Id'] in patient_ids:
+            trajectory = getRiskTrajectory(patient_data, getBorn(patient['Id']), patient['Gender'],
+                                           int(patient['Smoke']), int(patient['Diabetes']))
+        else:
+            trajectory = {'Time': np.array([], dtype='datetime64[s]')}
+        trajectory_chart(trajectory, trajectory_canvas)
+
+        self.canvas = canvas
+        self.info_lbl = info_lbl
+        self.engine = ScenarioEngine(patient)
+        self.redraw_pending = None
+        self.cohort_scores = {}
+        self.scenario_vars = {}
+
+        # What-if sliders, the chart is redrawn at most once per frame while dragging
+        whatif_frame = tk.Frame(self)
+        whatif_frame.grid(row=7, column=0, columnspan=6, padx=80, pady=5, sticky='w')
+
+        sliders = (('Blood pressure', 80, 240, 1), ('Cholesterol', 2, 20, 0.1), ('HDL', 0.3, 5, 0.1))
+        for column, (key, low, high, resolution) in enumerate(sliders):
+            scale = tk.Scale(whatif_frame, label=key, from_=low, to=high, resolution=resolution,
+                             orient=tk.HORIZONTAL, length=140,
+                             command=lambda value, key=key: self.changeScenario(key, value))
+            scale.set(self.engine.values[key])
+            scale.grid(row=0, column=column, padx=5)
+
+        for column, key in enumerate(('Smoke', 'Diabetes'), start=len(sliders)):
+            variable = tk.IntVar(value=int(self.engine.values[key]))
+            check = tk.Checkbutton(whatif_frame, text=key, variable=variable,
+                                   command=lambda key=key, variable=variable: self.changeScenario(key, variable.get()))
+            check.grid(row=0, column=column, padx=5, sticky='s')
+            self.scenario_vars[key] = variable
+
+        cohort_btn = tk.Button(whatif_frame, text="Apply to cohort...", command=self.applyToCohort)
+        cohort_btn.grid(row=1, column=0, padx=5, pady=5, sticky='w')
+        self.cohort_lbl = tk.Label(whatif_frame, text="", fg="#4C70AB")
+        self.cohort_lbl.grid(row=1, column=1, columnspan=4, sticky='w')
+
+        population_btn = tk.Button(whatif_frame, text="Population view",
+                                   command=lambda: controller.display_populationpage())
+        population_btn.grid(row=1, column=5, padx=5, pady=5, sticky='e')
+
+    def changeScenario(self, key, value):
+        """
+        Update the scenario and schedule a redraw of the chart for the next frame
+        """
+        self.engine.set(key, value)
+        if self.redraw_pending is None:
+            self.redraw_pending = self.after(16, self.redrawScenario)
+
+    def redrawScenario(self):
+        self.redraw_pending = None
+        risks = self.engine.risks()
+        updateHistogram(risks, self.canvas)
+        self.info_lbl.config(text="The risk of heart attack\nis {}%, the risk of\nstroke is {}%, and the\ncombined risk is {}%".format(
+            risks['Heart attack'], risks['Stroke'], risks['Both']))
+
+    def applyToCohort(self):
+        """
+        Apply the current scenario to a stored cohort and show the change of the mean risks
+        """
+        path = filedialog.askopenfilename(title="Open cohort file")
+        if not path:
+            return
+
+        try:
+            cohort = openCohort(path)
+        except (OSError, ValueError):
+            self.cohort_lbl.config(text="Could not open the cohort file", fg="red")
+            return
+
+        if path not in self.cohort_scores:
+            self.cohort_scores[path] = scoreCohort(cohort)
+        base = self.cohort_scores[path]
+        scenario = scoreCohort(cohort, self.engine.cohortScenario())
+
+        self.cohort_lbl.config(fg="#4C70AB", text="{} patients, mean combined risk {:.1f}% -> {:.1f}%".format(
+            len(cohort), base['Both'].mean(), scenario['Both'].mean()))
+
+class PopulationPage(tk.Frame):
+    """
+    Window that shows the risk distributions of the population and the patient's risks within them.
+    """
+    def __init__(self, parent, controller):
+        tk.Frame.__init__(self, parent)
+        self.controller = controller
+
+        # Buttons as navigation
+        nav_btn1 = tk.Button(self, text="Search patient", fg="#4C70AB", width=15, height=2,
+                             command=lambda: controller.display_searchpage())
+        nav_btn2 = tk.Button(self, text="Information form", fg="#4C70AB", width=15, height=2,
+                             command=lambda: controller.display_infopage())
+        nav_btn3 = tk.Button(self, text="Results", fg="#4C70AB", width=15, height=2,
+                             command=lambda: controller.display_resultpage())
+
+        nav_btn1.grid(row=0, column=0, rowspan=2, padx=0, pady=0)
+        nav_btn2.grid(row=0, column=1, rowspan=2, padx=0, pady=0)
+        nav_btn3.grid(row=0, column=2, rowspan=2, padx=0, pady=0)
+
+        # Empty rows to align elements
+        self.grid_rowconfigure(2, minsize=40)
+
+        name_lbl = tk.Label(self, text="Population", font=("Helvetica", 16), fg="#4C70AB")
+        name_lbl.grid(row=3, column=0, columnspan=3, padx=80, pady=20, sticky='w')
+
+        open_btn = tk.Button(self, text="Open population...", command=self.openPopulation)
+        open_btn.grid(row=3, column=3, padx=5, pady=20, sticky='w')
+
+        self.group_lbl = tk.Label(self, text="", fg="#4C70AB")
+        self.group_lbl.grid(row=4, column=0, columnspan=4, padx=80, sticky='w')
+
+        self.charts_frame = tk.Frame(self)
+        self.charts_frame.grid(row=5, column=0, columnspan=6, padx=40, pady=10, sticky='w')
+
+        self.showPopulation()
+
+    def openPopulation(self):
+        """
+        Open a saved population sketch (.npy) or build one from a cohort file
+        """
+        global population
+        path = filedialog.askopenfilename(title="Open population sketch or cohort file")
+        if not path:
+            return
+
+        try:
+            if path.endswith('.npy'):
+                population = PopulationSketch.load(path)
+            else:
+                population = sketchCohort(path, workers=os.cpu_count() or 1)
+        except (OSError, ValueError):
+            self.group_lbl.config(text="Could not open the population file", fg="red")
+            return
+
+        self.showPopulation()
+
+    def showPopulation(self):
+        for child in self.charts_frame.winfo_children():
+            child.destroy()
+
+        if population is None:
+            self.group_lbl.config(text="No population opened", fg="#4C70AB")
+            return
+
+        band = int(np.maximum(np.searchsorted(AGE_BANDS, int(patient['Age'] or 0), side='right') - 1, 0))
+        gender = patient.get('Gender') or None
+        self.group_lbl.config(fg="#4C70AB", text="Age {}, {}: {} patients".format(
+            ageBandName(band), gender or 'all genders', population.count('Both', band, gender)))
+
+        for column, key in enumerate(PopulationSketch.KEYS):
+            canvas = tk.Canvas(self.charts_frame, width=360, height=250)
+            canvas.grid(row=0, column=column, padx=5)
+            population_chart(population, key, result[key], band, gender, canvas)
+
+
+def writeBackCohort(path, writer, chunk_size=100000):
+    """
+    Score a cohort file and save the risks of its valid rows to the FHIR server as RiskAssessments
+    """
+    cohort = openCohort(path)
+    written = 0
+    for start in range(0, len(cohort), chunk_size):
+        chunk = cohort[start:start + chunk_size]
+        chunk = chunk[~validateCohort(chunk)['Any']]
+        writer.addAll(chunk['Id'], scoreCohort(chunk))
+        written += len(chunk)
+    writer.flush()
+    return written
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'write-back':
+        # batch run without the GUI: python RiskCalculator.py write-back cohort.bin
+        try:
+            count = writeBackCohort(sys.argv[2], RiskAssessmentWriter(client))
+        except requests.RequestException as error:
+            sys.exit('Could not write the RiskAssessments: {}'.format(error))
+        print('Saved the RiskAssessments of {} patients'.format(count))
+    else:
+        if os.environ.get('FHIR_WRITE_BACK'):
+            risk_writer = RiskAssessmentWriter(client)
+        ui = ContainerPages()
+        ui.mainloop()
 
 
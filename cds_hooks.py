@@ -0,0 +1,227 @@
+"""
+CDS Hooks service for the risk calculator.
+The service answers the patient-view hook with a card showing the heart attack, stroke and
+combined risk of the patient. The EHR sends the patient and the needed observations inline
+by the prefetch templates, so the risks are calculated without any requests to the FHIR server.
+When the prefetched data is missing, the precomputed score from the score cache is used.
+
+Usage: python cds_hooks.py [port] [score cache file]
+       python cds_hooks.py loadtest [url] [requests] [concurrency]
+"""
+
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from RiskCalculator import LOINC_SEARCH, ScoreCache, scorePatientData
+
+SERVICE_ID = 'finriski-risk'
+
+SERVICE = {
+    'hook': 'patient-view',
+    'id': SERVICE_ID,
+    'title': 'FINRISKI risk calculator',
+    'description': 'Risk of heart attack and stroke calculated from the latest vital signs',
+    'prefetch': {
+        'patient': 'Patient/{{context.patientId}}',
+        'observations': 'Observation?patient={{context.patientId}}&code=' + LOINC_SEARCH + '&_sort=-date'
+    }
+}
+
+# The combined risk (%) above which the card is shown as a warning
+WARNING_LIMIT = 10
+
+# Seconds between the checks for scores written to the cache file by the rescoring watcher
+RELOAD_INTERVAL = 5
+
+score_cache = ScoreCache()
+
+
+def scorePrefetch(prefetch, cached=None):
+    """
+    Calculate the risks from the prefetched patient and observations,
+    returns None if some of the needed values are missing
+    """
+    patient_record = prefetch.get('patient')
+    bundle = prefetch.get('observations') or {}
+    if not patient_record:
+        return None
+
+    # smoking and diabetes are only known if they have been filled in earlier
+    smoke = cached.get('Smoke', 0) if cached else 0
+    db = cached.get('Diabetes', 0) if cached else 0
+
+    return scorePatientData(patient_record, bundle.get('entry', []), smoke, db)
+
+
+def riskCard(risks, precomputed, assumed=False):
+    """
+    Build the CDS Hooks card from the risks. With assumed=True smoking and diabetes were not known
+    and the risks were calculated for a non-smoker without diabetes, which the card tells.
+    """
+    summary = 'Heart attack {} %, stroke {} %, combined {} %'.format(
+        risks['Heart attack'], risks['Stroke'], risks['Both'])
+    detail = 'Calculated from the latest blood pressure and cholesterol values.'
+    if precomputed:
+        detail = 'Precomputed score from {}.'.format(risks.get('Updated', 'an earlier calculation'))
+    if assumed:
+        summary += ' if non-smoker without diabetes'
+        detail += (' Smoking and diabetes are not recorded, so the patient is assumed to be a non-smoker'
+                   ' without diabetes. The risk is higher if either applies.')
+
+    return {
+        'summary': summary,
+        'detail': detail,
+        'indicator': 'warning' if risks['Both'] >= WARNING_LIMIT else 'info',
+        'source': {'label': 'FINRISKI risk calculator'}
+    }
+
+
+def handleHook(request):
+    """
+    Answer a patient-view hook request with the risk cards
+    """
+    patient_id = request.get('context', {}).get('patientId', '')
+    cached = score_cache.get(patient_id)
+    assumed = not cached or 'Smoke' not in cached or 'Diabetes' not in cached
+
+    risks = scorePrefetch(request.get('prefetch') or {}, cached)
+    if risks is not None:
+        extra = {key: cached[key] for key in ('Smoke', 'Diabetes') if cached and key in cached}
+        score_cache.put(patient_id, risks, **extra)
+        return {'cards': [riskCard(risks, False, assumed)]}
+
+    if cached is not None:
+        return {'cards': [riskCard(cached, True, assumed)]}
+
+    return {'cards': []}
+
+
+class CDSHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler for the discovery and the service endpoints
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent in one segment, so keep-alive requests do not wait for delayed ACKs
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/cds-services':
+            self._send_json(200, {'services': [SERVICE]})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/cds-services/' + SERVICE_ID:
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            hook_request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._send_json(400, {'error': 'Invalid json'})
+            return
+        if not isinstance(hook_request, dict) or not isinstance(hook_request.get('context', {}), dict) or \
+                not isinstance(hook_request.get('prefetch') or {}, dict):
+            self._send_json(400, {'error': 'The hook request has to be a json object'})
+            return
+
+        try:
+            response = handleHook(hook_request)
+        except Exception as error:
+            self._send_json(500, {'error': 'Could not calculate the risks: {!r}'.format(error)})
+            return
+        self._send_json(200, response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8080, cache_path=None):
+    """
+    Start the CDS Hooks service
+    """
+    global score_cache
+    score_cache = ScoreCache(cache_path)
+
+    def reloadScores():
+        while True:
+            time.sleep(RELOAD_INTERVAL)
+            try:
+                score_cache.reload()
+            except (OSError, ValueError) as error:
+                print('Could not reload the score cache: {}'.format(error))
+    threading.Thread(target=reloadScores, daemon=True).start()
+
+    server = ThreadingHTTPServer(('', port), CDSHandler)
+    print('CDS Hooks service running at http://localhost:{}/cds-services'.format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def loadTest(url='http://localhost:8080', n_requests=2000, concurrency=8):
+    """
+    Send patient-view hooks with prefetched data to the service and print the latencies in ms
+    """
+    hook_request = {
+        'hook': 'patient-view',
+        'hookInstance': 'loadtest',
+        'context': {'patientId': 'loadtest', 'userId': 'Practitioner/loadtest'},
+        'prefetch': {
+            'patient': {'resourceType': 'Patient', 'id': 'loadtest',
+                        'gender': 'female', 'birthDate': '1960-05-01'},
+            'observations': {'resourceType': 'Bundle', 'entry': [
+                {'resource': {'code': {'text': text}, 'valueQuantity': {'value': value}}}
+                for text, value in (('Systolic blood pressure', 142),
+                                    ('Cholest SerPl-mCnc', 210),
+                                    ('HDLc SerPl-mCnc', 48))]}
+        }
+    }
+    service_url = url + '/cds-services/' + SERVICE_ID
+    sessions = threading.local()
+
+    def send(_):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        session = sessions.session
+        start = time.perf_counter()
+        session.post(service_url, json=hook_request).raise_for_status()
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(send, range(n_requests)))
+
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print('{} requests: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        n_requests, p50, p99, latencies[-1]))
+    return p99
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'loadtest':
+        args = sys.argv[2:]
+        loadTest(args[0] if args else 'http://localhost:8080',
+                 int(args[1]) if len(args) > 1 else 2000,
+                 int(args[2]) if len(args) > 2 else 8)
+    else:
+        serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+              sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,133 @@
+"""
+Federated scoring across the FHIR servers of several regions.
+Each configured server has its own client with a connection pool and its own pool of threads,
+sized to the limit of concurrent requests of the server. The patient listings and the risk observations
+are fetched from all the servers in parallel, so the wall time follows the slowest server instead of
+the sum of them. The patients are tagged with the name of their server in meta.source and
+de-duplicated by their identifiers.
+
+The same patient id can mean different patients on different servers, so the federated score cache
+is keyed by '<server name>/<patient id>'. It is a file of its own, separate from the single server
+cache of cds_hooks.py and rescore_watcher.py that is keyed by the plain patient id.
+
+The configuration is a json list of servers:
+    [{"name": "north", "url": "https://...", "user": "", "password": "", "concurrency": 8}, ...]
+
+Usage: python federation.py [servers file] [federated score cache file] [--write-back]
+With --write-back the risks are also saved as RiskAssessment resources to the server of each patient.
+"""
+
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from RiskCalculator import RiskAssessmentWriter, ScoreCache, SimpleFHIRClient, scorePatientData
+
+
+class FederatedClient(object):
+    """
+    Holds the clients of the configured servers and fans the requests out to all of them
+    """
+    def __init__(self, servers):
+        self.sources = []
+        for server in servers:
+            concurrency = server.get('concurrency', 8)
+            fhir_client = SimpleFHIRClient(server['url'], server.get('user', ''), server.get('password', ''),
+                                           pool_size=concurrency)
+            # a pool per server, so the requests of one server never wait behind the queue of another
+            self.sources.append((server['name'], fhir_client, ThreadPoolExecutor(concurrency)))
+
+    def getAllPatients(self):
+        """
+        The patients of all the servers, tagged with their source. A patient found on several
+        servers is kept from the first server of the configuration.
+        """
+        futures = [executor.submit(fhir_client.getAllPatients) for name, fhir_client, executor in self.sources]
+
+        all_patients = []
+        seen = set()
+        for (name, fhir_client, executor), future in zip(self.sources, futures):
+            try:
+                patients = future.result()
+            except requests.RequestException as error:
+                print('Could not list the patients of {}: {}'.format(name, error))
+                continue
+
+            for patient_record in patients:
+                identifiers = {identifier.get('system', '') + '|' + identifier['value']
+                               for identifier in patient_record.get('identifier', []) if 'value' in identifier}
+                if identifiers & seen:
+                    continue
+                seen |= identifiers
+
+                patient_record.setdefault('meta', {})['source'] = name
+                all_patients.append(patient_record)
+
+        return all_patients
+
+    def iterPatientData(self, all_patients):
+        """
+        Fetch the risk observations of the patients (newest first) from their own servers in parallel,
+        yields (patient record, bundle entries) in the order the fetches finish
+        """
+        sources = {name: (fhir_client, executor) for name, fhir_client, executor in self.sources}
+        futures = {}
+        for patient_record in all_patients:
+            fhir_client, executor = sources[patient_record['meta']['source']]
+            futures[executor.submit(fhir_client.getRiskObservations, patient_record['id'])] = patient_record
+
+        for future in as_completed(futures):
+            patient_record = futures[future]
+            try:
+                yield patient_record, future.result()
+            except requests.RequestException as error:
+                print('Could not fetch patient {} of {}: {}'.format(
+                    patient_record['id'], patient_record['meta']['source'], error))
+
+    def scoreAll(self, score_cache=None, write_back=False):
+        """
+        Score the patients of all the servers, yields (source, patient id, risks).
+        Smoking and diabetes are taken from the federated score cache when they are known.
+        With write_back=True the risks are saved to the server of the patient as RiskAssessments.
+        """
+        writers = {name: RiskAssessmentWriter(fhir_client) for name, fhir_client, executor in self.sources} \
+            if write_back else {}
+
+        for patient_record, all_data in self.iterPatientData(self.getAllPatients()):
+            key = patient_record['meta']['source'] + '/' + patient_record['id']
+            cached = score_cache.get(key) if score_cache is not None else None
+            smoke = cached.get('Smoke', 0) if cached else 0
+            db = cached.get('Diabetes', 0) if cached else 0
+
+            risks = scorePatientData(patient_record, all_data, smoke, db)
+            if risks is None:
+                continue
+            if score_cache is not None:
+                score_cache.put(key, risks, Smoke=smoke, Diabetes=db)
+            if write_back:
+                self._writeBack(writers[patient_record['meta']['source']].add, patient_record['id'], risks)
+            yield patient_record['meta']['source'], patient_record['id'], risks
+
+        for name, writer in writers.items():
+            self._writeBack(writer.flush)
+
+    @staticmethod
+    def _writeBack(function, *args):
+        # a failed Bundle stays queued in the writer and is sent again with the next flush
+        try:
+            function(*args)
+        except requests.RequestException as error:
+            print('Could not write the RiskAssessments: {}'.format(error))
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--write-back']
+    with open(args[0] if args else 'servers.json') as f:
+        federation = FederatedClient(json.load(f))
+    cache = ScoreCache(args[1] if len(args) > 1 else 'federated_scores.json')
+
+    scored = sum(1 for _ in federation.scoreAll(cache, '--write-back' in sys.argv))
+    cache.save()
+    print('Scored {} patients from {} servers'.format(scored, len(federation.sources)))
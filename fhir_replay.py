@@ -0,0 +1,427 @@
+"""
+Record-and-replay FHIR server for offline load and latency testing.
+The recorder saves the responses that SimpleFHIRClient gets from a real server into a directory,
+and the replay server serves them back with configurable latency, jitter, errors and paging.
+With --scale the replay server synthesizes any number of patients from the recorded ones.
+The server also has a mock SMART Backend Services token endpoint at /token.
+
+Usage: python fhir_replay.py record [directory]            (FHIR_SERVER_URL must be set)
+       python fhir_replay.py serve [directory] [--port 8090] [--latency 50] [--jitter 10]
+                                   [--errors 0.01] [--page-size 50] [--scale 10000]
+                                   [--require-token] [--token-lifetime 300]
+       python fhir_replay.py benchmark [server url] [--patients 200] [--workers 16]
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+from RiskCalculator import FHIRBatchCoalescer, SimpleFHIRClient
+
+EVERYTHING = re.compile(r'^Patient/([^/$?]+)/?\$everything$')
+PATIENT_READ = re.compile(r'^Patient/([^/$?]+)$')
+
+# Query parameters that do not change the recorded response
+IGNORED_PARAMETERS = ('_format', '_page', '_count')
+
+
+def requestKey(requesturl, server_url=''):
+    """
+    Normalize a request url into the key of the recording: the path relative to the server
+    and the sorted query parameters
+    """
+    if server_url and requesturl.startswith(server_url):
+        requesturl = requesturl[len(server_url):]
+    parts = urlsplit(requesturl)
+    path = parts.path.strip('/')
+    # the client asks for Patient/<id>$everything, the batch entries for Patient/<id>/$everything
+    path = re.sub(r'([^/])\$everything$', r'\1/$everything', path)
+    query = sorted((name, value) for name, value in parse_qsl(parts.query) if name not in IGNORED_PARAMETERS)
+    return path + ('?' + urlencode(query) if query else '')
+
+
+def nextLink(bundle):
+    return next((link['url'] for link in bundle.get('link', []) if link.get('relation') == 'next'), None)
+
+
+def withoutLinks(body):
+    """
+    The response without the paging links, which point to the recorded server
+    """
+    if isinstance(body, dict) and 'link' in body:
+        body = dict(body)
+        del body['link']
+    return body
+
+
+class TrafficRecorder(object):
+    """
+    Saves the responses of SimpleFHIRClient._get_json into a directory, one json file per request.
+    The pages of a paged search are merged into the response of its first request.
+    """
+    def __init__(self, directory, server_url):
+        self.directory = directory
+        self.server_url = server_url
+        self.lock = threading.Lock()
+        # the keys of the next pages to come, mapped to the key of their first page
+        self.continuations = {}
+        self.pages = {}
+        os.makedirs(directory, exist_ok=True)
+
+        self.index_path = os.path.join(directory, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def record(self, requesturl, result):
+        key = requestKey(requesturl, self.server_url)
+        next_url = nextLink(result) if isinstance(result, dict) else None
+
+        with self.lock:
+            first_key = self.continuations.pop(key, None)
+            if first_key is not None:
+                merged = self.pages[first_key]
+                merged['entry'] = merged.get('entry', []) + result.get('entry', [])
+                key, result = first_key, merged
+            result = withoutLinks(result)
+
+            if next_url is not None:
+                self.pages[key] = result
+                self.continuations[requestKey(next_url, self.server_url)] = key
+            else:
+                self.pages.pop(key, None)
+
+            file_name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+            with open(os.path.join(self.directory, file_name), 'w') as f:
+                json.dump(result, f)
+
+            self.index[key] = file_name
+            with open(self.index_path, 'w') as f:
+                json.dump(self.index, f, indent=1)
+
+
+def recordServer(directory):
+    """
+    Fetch the patient listing and the data of every patient from the server of the
+    FHIR_SERVER_URL environment variable and record the responses
+    """
+    client = SimpleFHIRClient(os.environ['FHIR_SERVER_URL'], os.environ.get('FHIR_SERVER_USER', ''),
+                              os.environ.get('FHIR_SERVER_PASSWORD', ''))
+    client.recorder = TrafficRecorder(directory, client.server_url)
+
+    all_patients = client.getAllPatients()
+    for patient_record in all_patients:
+        client.getPatient(patient_record['id'])
+        client.getAllDataForPatient(patient_record['id'])
+    print('Recorded {} patients into {}'.format(len(all_patients), directory))
+
+
+class Recording(object):
+    """
+    The recorded responses, and the synthetic patients made from them
+    """
+    def __init__(self, directory, scale=0):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as f:
+            self.index = json.load(f)
+        self.cache = {}
+        self.synthetic_listing = None
+
+        listing = self.load('Patient') or {'entry': []}
+        self.templates = [entry['resource'] for entry in listing.get('entry', [])]
+        self.scale = scale if self.templates else 0
+
+    def load(self, key):
+        if key not in self.cache:
+            if key not in self.index:
+                return None
+            with open(os.path.join(self.directory, self.index[key])) as f:
+                # recordings made before the pages were merged still have the links of the server
+                self.cache[key] = withoutLinks(json.load(f))
+        return self.cache[key]
+
+    def syntheticPatient(self, number):
+        template = self.templates[number % len(self.templates)]
+        synthetic = copy.deepcopy(template)
+        synthetic['id'] = 'syn-{}'.format(number)
+        for identifier in synthetic.get('identifier', []):
+            identifier['value'] = '{}-syn-{}'.format(identifier.get('value', ''), number)
+        if 'birthDate' in template:
+            # spread the ages, the same number always gives the same patient
+            born = date.fromisoformat(template['birthDate']) + timedelta(days=(number * 7919) % 3650 - 1825)
+            synthetic['birthDate'] = born.isoformat()
+        return synthetic, template['id']
+
+    def response(self, key):
+        """
+        The response body for the request key, or None if it is not known
+        """
+        if not self.scale:
+            return self.load(key)
+
+        if key == 'Patient':
+            if self.synthetic_listing is None:
+                self.synthetic_listing = {
+                    'resourceType': 'Bundle', 'type': 'searchset', 'total': self.scale,
+                    'entry': [{'resource': self.syntheticPatient(number)[0]} for number in range(self.scale)]}
+            return self.synthetic_listing
+
+        for pattern in (EVERYTHING, PATIENT_READ):
+            match = pattern.match(key)
+            if match and match.group(1).startswith('syn-'):
+                number = int(match.group(1)[4:])
+                if number >= self.scale:
+                    return None
+                synthetic, template_id = self.syntheticPatient(number)
+                if pattern is PATIENT_READ:
+                    return synthetic
+                everything = self.load(key.replace(match.group(1), template_id, 1))
+                if everything is None:
+                    return None
+                text = json.dumps(everything).replace('Patient/' + template_id + '"', 'Patient/' + synthetic['id'] + '"')
+                return json.loads(text)
+
+        return self.load(key)
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler that serves the recording like a FHIR server
+    """
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    recording = None
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    page_size = 0
+
+    # Mock SMART Backend Services token endpoint at /token
+    token_lifetime = 300
+    require_token = False
+    tokens = {}
+    token_requests = 0
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _failed(self):
+        return self.error_rate and random.random() < self.error_rate
+
+    def _page(self, body, query):
+        """
+        Split a searchset Bundle into pages with next links
+        """
+        page_size = int(query.get('_count', self.page_size) or 0)
+        if not page_size or body.get('resourceType') != 'Bundle' or len(body.get('entry', [])) <= page_size:
+            return body
+
+        page = int(query.get('_page', 0))
+        paged = dict(body)
+        paged['entry'] = body['entry'][page * page_size:(page + 1) * page_size]
+        if (page + 1) * page_size < len(body['entry']):
+            next_query = dict(query, _page=page + 1)
+            next_url = 'http://{}{}?{}'.format(self.headers.get('Host', 'localhost'),
+                                               urlsplit(self.path).path, urlencode(next_query))
+            paged['link'] = [{'relation': 'next', 'url': next_url}]
+        return paged
+
+    def _authorized(self):
+        if not self.require_token:
+            return True
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        return self.tokens.get(token, 0) > time.time()
+
+    def _issue_token(self, form):
+        if form.get('grant_type') != 'client_credentials' or 'client_assertion' not in form:
+            self._send_json(400, {'error': 'invalid_request'})
+            return
+
+        # the assertion is not verified, the endpoint is only for testing the token handling
+        cls = type(self)
+        cls.token_requests += 1
+        token = uuid.uuid4().hex
+        cls.tokens[token] = time.time() + self.token_lifetime
+        self._send_json(200, {'access_token': token, 'token_type': 'bearer',
+                              'expires_in': self.token_lifetime, 'scope': form.get('scope', '')})
+
+    def do_GET(self):
+        self._delay()
+        if self._failed():
+            self._send_json(503, operationOutcome('Injected error'))
+            return
+
+        if not self._authorized():
+            self._send_json(401, operationOutcome('Invalid or expired token'))
+            return
+
+        body = self.recording.response(requestKey(self.path))
+        if body is None:
+            self._send_json(404, operationOutcome('Not recorded: ' + self.path))
+        else:
+            self._send_json(200, self._page(body, dict(parse_qsl(urlsplit(self.path).query))))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if urlsplit(self.path).path.rstrip('/') == '/token':
+            self._issue_token(dict(parse_qsl(body.decode('utf-8'))))
+            return
+
+        try:
+            bundle = json.loads(body)
+        except ValueError:
+            self._send_json(400, operationOutcome('Invalid json'))
+            return
+
+        self._delay()
+        if self._failed():
+            self._send_json(503, operationOutcome('Injected error'))
+            return
+
+        if not self._authorized():
+            self._send_json(401, operationOutcome('Invalid or expired token'))
+            return
+
+        if bundle.get('resourceType') != 'Bundle' or bundle.get('type') not in ('batch', 'transaction'):
+            self._send_json(201, bundle)
+            return
+
+        entries = []
+        for entry in bundle.get('entry', []):
+            request = entry.get('request', {})
+            if request.get('method') == 'GET':
+                body = self.recording.response(requestKey(request.get('url', '')))
+                if body is None:
+                    entries.append({'response': {'status': '404 Not Found'}})
+                else:
+                    entries.append({'resource': body, 'response': {'status': '200 OK'}})
+            else:
+                entries.append({'response': {'status': '201 Created'}})
+
+        self._send_json(200, {'resourceType': 'Bundle', 'type': bundle['type'] + '-response', 'entry': entries})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def operationOutcome(text):
+    return {'resourceType': 'OperationOutcome',
+            'issue': [{'severity': 'error', 'code': 'processing', 'diagnostics': text}]}
+
+
+def replayServer(directory, port=8090, latency=0, jitter=0, error_rate=0, page_size=0, scale=0,
+                 require_token=False, token_lifetime=300):
+    """
+    Create the replay server, latency and jitter are given in milliseconds
+    """
+    handler = type('ConfiguredReplayHandler', (ReplayHandler,), {
+        'recording': Recording(directory, scale),
+        'latency': latency / 1000,
+        'jitter': jitter / 1000,
+        'error_rate': error_rate,
+        'page_size': page_size,
+        'require_token': require_token,
+        'token_lifetime': token_lifetime,
+        'tokens': {}
+    })
+    return ThreadingHTTPServer(('', port), handler)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    try:
+        function(*args)
+        return (time.perf_counter() - start) * 1000, True
+    except requests.RequestException:
+        return (time.perf_counter() - start) * 1000, False
+
+
+def printTimes(mode, times, total_time):
+    latencies = sorted(latency for latency, ok in times)
+    errors = sum(1 for latency, ok in times if not ok)
+    print('{:<12} {:>7.1f} req/s  p50 {:>7.1f} ms  p99 {:>7.1f} ms  errors {}'.format(
+        mode, len(times) / total_time, latencies[len(latencies) // 2],
+        latencies[max(int(len(latencies) * 0.99) - 1, 0)], errors))
+
+
+def benchmark(server_url, n_patients=200, workers=16):
+    """
+    Measure the throughput and latency of the ways to fetch the patient data
+    """
+    client = SimpleFHIRClient(server_url, '', '')
+
+    start = time.perf_counter()
+    patient_ids = [patient_record['id'] for patient_record in client.getAllPatients()][:n_patients]
+    print('listing      {:>7.1f} ms for {} patients'.format((time.perf_counter() - start) * 1000, len(patient_ids)))
+
+    start = time.perf_counter()
+    times = [timed(client.getAllDataForPatient, patient_id) for patient_id in patient_ids]
+    printTimes('sequential', times, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        times = list(executor.map(lambda patient_id: timed(client.getAllDataForPatient, patient_id), patient_ids))
+    printTimes('threads', times, time.perf_counter() - start)
+
+    coalescer = FHIRBatchCoalescer(client, window=0.005, max_requests=workers)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        times = list(executor.map(lambda patient_id: timed(coalescer.getAllDataForPatient, patient_id), patient_ids))
+    printTimes('batch', times, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record-and-replay FHIR server')
+    parser.add_argument('mode', choices=('record', 'serve', 'benchmark'))
+    parser.add_argument('target', nargs='?', help='recording directory or server url')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0, help='ms')
+    parser.add_argument('--jitter', type=float, default=0, help='ms')
+    parser.add_argument('--errors', type=float, default=0, help='share of failing requests')
+    parser.add_argument('--page-size', type=int, default=0)
+    parser.add_argument('--scale', type=int, default=0, help='number of synthetic patients')
+    parser.add_argument('--require-token', action='store_true', help='require tokens from the mock /token endpoint')
+    parser.add_argument('--token-lifetime', type=int, default=300, help='s')
+    parser.add_argument('--patients', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        recordServer(args.target or 'recording')
+    elif args.mode == 'serve':
+        server = replayServer(args.target or 'recording', args.port, args.latency, args.jitter,
+                              args.errors, args.page_size, args.scale, args.require_token, args.token_lifetime)
+        print('Replaying at http://localhost:{}'.format(args.port))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    else:
+        benchmark(args.target or 'http://localhost:{}'.format(args.port), args.patients, args.workers)
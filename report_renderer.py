@@ -0,0 +1,159 @@
+"""
+Headless rendering of the risk charts into per-patient report files, without Tk or a display.
+The chart is drawn from the same layout as results_histogram of the result page, imported from
+risk_scoring so that tkinter is not needed. The parts that are the same for every patient are rendered
+once per worker into a template, so a report only adds the bars and the percentages.
+SVG is written directly; PNG and PDF need the cairosvg package.
+Each report is named after the patient id. Ids with characters that are not safe in file names,
+and ids that appear on several rows, get the row number of the cohort as a suffix.
+
+Usage: python report_renderer.py [cohort file] [output directory] [svg|png|pdf] [workers]
+"""
+
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from risk_scoring import histogramLayout, openCohort, scoreCohort, validateCohort
+
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+REPORT_WIDTH = 400
+REPORT_HEIGHT = 340
+
+# Tk anchors of the canvas texts as SVG text-anchor values
+TEXT_ANCHORS = {'center': 'middle', 'w': 'start', 'e': 'end'}
+
+# The static part of the report, made once in each worker process
+report_template = None
+
+# Characters kept in the report file names, FHIR ids only use letters, digits, '-' and '.'
+UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9.-]')
+
+
+def svgItem(kind, coords, options):
+    """
+    One layout item of histogramLayout as an SVG element
+    """
+    if kind == 'line':
+        x0, y0, x1, y1 = coords
+        return '<line x1="{}" y1="{}" x2="{}" y2="{}" stroke="black"/>'.format(x0, y0, x1, y1)
+
+    if kind == 'rectangle':
+        x0, y0, x1, y1 = coords
+        return '<rect x="{}" y="{}" width="{}" height="{}" fill="{}" stroke="black"/>'.format(
+            x0, y0, x1 - x0, y1 - y0, options.get('fill', 'none'))
+
+    if kind == 'text':
+        x, y = coords
+        family, size = options.get('font', ("Helvetica", 11))
+        return ('<text x="{}" y="{}" fill="{}" font-family="{}" font-size="{}pt" text-anchor="{}" '
+                'dominant-baseline="central">{}</text>').format(
+            x, y, options.get('fill', 'black'), family, size,
+            TEXT_ANCHORS[options.get('anchor', 'center')], escape(options['text']))
+
+    raise ValueError('Unknown layout item: ' + kind)
+
+
+def reportTemplate():
+    """
+    The SVG document up to the patient specific items, with the static items of the chart
+    """
+    static_items = [svgItem(kind, coords, options)
+                    for kind, coords, options in histogramLayout({'Heart attack': 0, 'Stroke': 0, 'Both': 0})
+                    if 'tags' not in options]
+    header = ('<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}">'
+              '<rect width="100%" height="100%" fill="white"/>').format(REPORT_WIDTH, REPORT_HEIGHT)
+    return header + ''.join(static_items)
+
+
+def renderReport(patient_id, risks):
+    """
+    The SVG report of one patient
+    """
+    global report_template
+    if report_template is None:
+        report_template = reportTemplate()
+
+    dynamic_items = [svgItem(kind, coords, options)
+                     for kind, coords, options in histogramLayout(risks) if 'tags' in options]
+    title = svgItem('text', (REPORT_WIDTH // 2, 320), {'text': 'Patient ' + patient_id, 'fill': "#4C70AB"})
+    return report_template + ''.join(dynamic_items) + title + '</svg>'
+
+
+def reportName(patient_id, row, duplicate=False):
+    """
+    File name of the report without the extension. Ids that are not safe as file names and
+    ids of several rows get the row number of the cohort after an '_', which no FHIR id has,
+    so the names cannot collide.
+    """
+    name = UNSAFE_CHARACTERS.sub('_', patient_id)
+    if duplicate or name != patient_id or name.strip('.') == '':
+        name = '{}_{}'.format(name, row)
+    return name
+
+
+def writeReport(path, svg, output_format):
+    if output_format == 'svg':
+        with open(path, 'w') as f:
+            f.write(svg)
+    elif output_format == 'png':
+        cairosvg.svg2png(bytestring=svg.encode('utf-8'), write_to=path)
+    else:
+        cairosvg.svg2pdf(bytestring=svg.encode('utf-8'), write_to=path)
+
+
+def renderCohortPart(cohort_path, out_dir, start, stop, output_format, duplicates=frozenset()):
+    """
+    Render the reports of one part of the cohort, run in a worker process.
+    The rows with invalid values are skipped like in the population sketches.
+    """
+    cohort = openCohort(cohort_path)[start:stop]
+    valid = ~validateCohort(cohort)['Any']
+    rows = np.flatnonzero(valid) + start
+    cohort = cohort[valid]
+    risks = scoreCohort(cohort)
+
+    for i, patient_id in enumerate(cohort['Id']):
+        patient_id = patient_id.decode('utf-8')
+        patient_risks = {key: round(float(values[i]), 1) for key, values in risks.items()}
+        path = os.path.join(out_dir, reportName(patient_id, rows[i], patient_id in duplicates) + '.' + output_format)
+        writeReport(path, renderReport(patient_id, patient_risks), output_format)
+    return len(cohort)
+
+
+def renderCohortReports(cohort_path, out_dir, output_format='svg', workers=None, part_size=10000):
+    """
+    Render a report file for every patient of the cohort file across a pool of processes
+    """
+    if output_format not in ('svg', 'png', 'pdf'):
+        raise ValueError('Unknown report format: ' + output_format)
+    if output_format != 'svg' and cairosvg is None:
+        raise ImportError('PNG and PDF reports need the cairosvg package (pip install cairosvg)')
+
+    os.makedirs(out_dir, exist_ok=True)
+    ids, counts = np.unique(openCohort(cohort_path)['Id'], return_counts=True)
+    duplicates = frozenset(patient_id.decode('utf-8') for patient_id in ids[counts > 1])
+    size = int(counts.sum())
+    starts = range(0, size, part_size)
+
+    with ProcessPoolExecutor(workers) as executor:
+        rendered = executor.map(renderCohortPart, [cohort_path] * len(starts), [out_dir] * len(starts),
+                                starts, [min(start + part_size, size) for start in starts],
+                                [output_format] * len(starts), [duplicates] * len(starts))
+        return sum(rendered)
+
+
+if __name__ == '__main__':
+    out_dir = sys.argv[2] if len(sys.argv) > 2 else 'reports'
+    count = renderCohortReports(sys.argv[1] if len(sys.argv) > 1 else 'cohort.bin', out_dir,
+                                sys.argv[3] if len(sys.argv) > 3 else 'svg',
+                                int(sys.argv[4]) if len(sys.argv) > 4 else None)
+    print('Rendered {} reports into {}'.format(count, out_dir))
@@ -0,0 +1,236 @@
+"""
+Watcher that keeps the precomputed scores of the score cache up to date.
+New and changed observations are found by polling Observation/_history?_since= or
+received as FHIR Subscription (rest-hook) notifications on a local endpoint. Notifications
+without the observations (empty or id-only payloads) start one poll of the history instead.
+Only the patients whose blood pressure or cholesterol values have changed are rescored,
+so the work follows the rate of the changes instead of the size of the patient panel.
+
+Usage: python rescore_watcher.py poll [score cache file] [interval in seconds] [--write-back]
+       python rescore_watcher.py subscribe [score cache file] [port] [--write-back]
+With --write-back the new risks are also saved to the FHIR server as RiskAssessment resources.
+"""
+
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from RiskCalculator import (RiskAssessmentWriter, ScoreCache, client, scorePatientData,
+                            OBSERVATION_CODES)
+
+
+def isRiskObservation(resource):
+    """
+    Check whether the observation is one of the values used in the risk calculation
+    """
+    if resource.get('resourceType') != 'Observation':
+        return False
+    code = resource.get('code', {})
+    return code.get('text') in OBSERVATION_CODES or \
+        any(coding.get('code') in OBSERVATION_CODES.values() for coding in code.get('coding', []))
+
+
+def changedPatientIds(resources):
+    """
+    Map the changed observations to the ids of the patients they belong to
+    """
+    patient_ids = set()
+    for resource in resources:
+        if not isRiskObservation(resource):
+            continue
+        reference = resource.get('subject', {}).get('reference', '')
+        if reference.startswith('Patient/'):
+            patient_ids.add(reference.split('/')[1])
+    return patient_ids
+
+
+def rescorePatients(patient_ids, score_cache, writer=None):
+    """
+    Fetch the data of the given patients and write the new risks to the score cache
+    and, if a RiskAssessmentWriter is given, back to the FHIR server
+    """
+    rescored = 0
+    for patient_id in patient_ids:
+        cached = score_cache.get(patient_id) or {}
+        smoke = cached.get('Smoke', 0)
+        db = cached.get('Diabetes', 0)
+        try:
+            patient_record = client.getPatient(patient_id)
+            all_data = client.getRiskObservations(patient_id)
+        except requests.RequestException as error:
+            print('Could not fetch patient {}: {}'.format(patient_id, error))
+            continue
+
+        try:
+            risks = scorePatientData(patient_record, all_data, smoke, db)
+        except Exception as error:
+            # one malformed patient must not stop the rescoring of the others
+            print('Could not score patient {}: {!r}'.format(patient_id, error))
+            continue
+        if risks is not None:
+            score_cache.put(patient_id, risks, Smoke=smoke, Diabetes=db)
+            if writer is not None:
+                writeBack(writer.add, patient_id, risks)
+            rescored += 1
+
+    score_cache.save()
+    if writer is not None:
+        writeBack(writer.flush)
+    return rescored
+
+
+def writeBack(function, *args):
+    """
+    Call a method of the RiskAssessmentWriter. A failed write is only logged, as the writer keeps
+    the RiskAssessments queued and sends them again with the next flush.
+    """
+    try:
+        function(*args)
+    except requests.RequestException as error:
+        print('Could not write the RiskAssessments: {}'.format(error))
+
+
+def historyChanges(since):
+    """
+    Poll the observation history once, returns the ids of the changed patients and the since of the next poll.
+    The next poll starts from the server time of this one, so no change is missed even if the clocks differ.
+    """
+    # only used if the server tells no time, a little earlier so that a small clock difference is covered
+    poll_time = (datetime.now(timezone.utc) - timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    try:
+        resources, server_time = client.getObservationHistory(since)
+    except requests.RequestException as error:
+        print('Polling the history failed: {}'.format(error))
+        return set(), since
+    return changedPatientIds(resources), server_time or max(since, poll_time)
+
+
+def pollHistory(score_cache, interval=60, since=None, writer=None):
+    """
+    Poll the observation history and rescore the patients with changed observations
+    """
+    if since is None:
+        since = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    while True:
+        patient_ids, since = historyChanges(since)
+        if patient_ids:
+            try:
+                print('Rescored {} patients'.format(rescorePatients(patient_ids, score_cache, writer)))
+            except Exception as error:
+                print('Rescoring failed: {!r}'.format(error))
+
+        time.sleep(interval)
+
+
+class RescoreQueue(object):
+    """
+    Collects the patient ids of the notifications, so a burst of notifications
+    for the same patient is rescored only once. A burst of notifications without
+    the observations is handled with one poll of the history.
+    """
+    def __init__(self, score_cache, writer=None, since=None):
+        self.score_cache = score_cache
+        self.writer = writer
+        self.pending = set()
+        self.poll_requested = False
+        self.since = since or datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.condition = threading.Condition()
+
+    def add(self, patient_ids):
+        with self.condition:
+            self.pending.update(patient_ids)
+            self.condition.notify()
+
+    def requestPoll(self):
+        with self.condition:
+            self.poll_requested = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.poll_requested:
+                    self.condition.wait()
+                patient_ids = self.pending
+                poll = self.poll_requested
+                self.pending = set()
+                self.poll_requested = False
+            if poll:
+                changed, self.since = historyChanges(self.since)
+                patient_ids |= changed
+            if not patient_ids:
+                continue
+            try:
+                rescorePatients(patient_ids, self.score_cache, self.writer)
+            except Exception as error:
+                # the thread has to keep running, or the later notifications are never rescored
+                print('Rescoring failed: {!r}'.format(error))
+
+
+class SubscriptionHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler for the rest-hook notifications of a FHIR Subscription
+    """
+    queue = None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            notification = json.loads(self.rfile.read(length)) if length else {}
+        except ValueError:
+            notification = {}
+
+        if notification.get('resourceType') == 'Bundle':
+            resources = [entry['resource'] for entry in notification.get('entry', []) if 'resource' in entry]
+        else:
+            resources = [notification] if notification else []
+
+        # with an empty or id-only payload the changed observations have to be read from the history
+        if not resources or any('subject' not in resource for resource in resources
+                                if resource.get('resourceType') in (None, 'Observation')):
+            self.queue.requestPoll()
+        self.queue.add(changedPatientIds(resources))
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # the Subscription handshake sends an empty notification with PUT in some servers
+    do_PUT = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def subscribe(score_cache, port=8081, writer=None):
+    """
+    Receive the Subscription notifications and rescore the patients in the background
+    """
+    queue = RescoreQueue(score_cache, writer)
+    threading.Thread(target=queue.run, daemon=True).start()
+
+    SubscriptionHandler.queue = queue
+    server = ThreadingHTTPServer(('', port), SubscriptionHandler)
+    print('Waiting for notifications at http://localhost:{}/'.format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--write-back']
+    mode = args[0] if args else 'poll'
+    cache = ScoreCache(args[1] if len(args) > 1 else 'scores.json')
+    risk_writer = RiskAssessmentWriter(client) if '--write-back' in sys.argv else None
+
+    if mode == 'subscribe':
+        subscribe(cache, int(args[2]) if len(args) > 2 else 8081, risk_writer)
+    else:
+        pollHistory(cache, int(args[2]) if len(args) > 2 else 60, writer=risk_writer)
@@ -0,0 +1,412 @@
+"""
+The risk models and the rest of the calculator that does not need the GUI: the vectorized scoring,
+the input validation and units, the binary cohort files, the population sketches and the layout of
+the risk histogram. Nothing here imports tkinter, so batch jobs and worker processes can run
+on servers without a display. RiskCalculator.py imports the parts it uses from here.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# The risks calculated for every patient, in the order of the result struct
+RISK_KEYS = ('Heart attack', 'Stroke', 'Both')
+
+
+# Accepted ranges of the input values, shared by the information form and the batch runs
+VALID_RANGES = {
+    'Age': (0, 120),
+    'Blood pressure': (80, 240),
+    'HDL': (0.3, 5),
+    'Cholesterol': (2, 20)
+}
+
+# Factors from the UCUM units of the observations to the units of the risk models (mmHg and mmol/L)
+UNIT_FACTORS = {
+    'Blood pressure': {'mm[Hg]': 1, 'mmHg': 1, 'kPa': 7.50062},
+    'Cholesterol': {'mmol/L': 1, 'mg/dL': 10/386.65, 'g/L': 100/386.65},
+    'HDL': {'mmol/L': 1, 'mg/dL': 10/386.65, 'g/L': 100/386.65}
+}
+
+# Unit assumed when the observation does not tell it
+DEFAULT_UNITS = {'Blood pressure': 'mm[Hg]', 'Cholesterol': 'mg/dL', 'HDL': 'mg/dL'}
+
+
+def toNumbers(values):
+    """
+    Convert a value or an array of values (numbers or strings) to floats, the ones that are not numbers become NaN
+    """
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        def toNumber(value):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return np.nan
+        return np.vectorize(toNumber, otypes=[float])(values)
+
+
+def normalizeValues(key, values, units=None):
+    """
+    Convert the values of the given input from their UCUM units to the units of the risk models.
+    Values and units can be single values or arrays, values with an unknown unit become NaN.
+    The units are matched without case and spaces, as the free text units are written in many ways.
+    """
+    values = toNumbers(values)
+    factors = UNIT_FACTORS[key]
+    units = np.asarray(DEFAULT_UNITS[key] if units is None else units, dtype=str)
+    units = np.char.replace(np.char.lower(units), ' ', '')
+
+    factor = np.full(units.shape, np.nan)
+    factor[units == ''] = factors[DEFAULT_UNITS[key]]
+    for unit, unit_factor in factors.items():
+        factor[units == unit.lower()] = unit_factor
+    return values * factor
+
+
+def validateInputs(values):
+    """
+    Check the input values against VALID_RANGES. The values are a dict keyed like the patient struct,
+    each a single value or a column of values (numbers or strings). Returns a dict of error masks
+    with the same keys and 'Any' for the rows that have some error.
+    """
+    errors = {}
+    for key, column in values.items():
+        numbers = toNumbers(column)
+        low, high = VALID_RANGES[key]
+        with np.errstate(invalid='ignore'):
+            error = np.isnan(numbers) | (numbers < low) | (numbers > high)
+            if key == 'Age':
+                error |= numbers != np.floor(numbers)
+                # ages typed in the form have to be whole numbers like before, not e.g. 65.0 or 1e1
+                strings = np.asarray(column)
+                if strings.dtype.kind in 'US':
+                    error |= ~np.char.isdigit(np.char.strip(strings))
+        errors[key] = error
+
+    errors['Any'] = np.logical_or.reduce(list(errors.values())) if errors else np.False_
+    return errors
+
+
+# Terms of the exponent in the risk models: the intercept and the coefficients
+# of age, smoking, cholesterol, HDL, blood pressure and diabetes
+STROKE_MODEL = {
+    'female': (9.553, -0.085, -0.613, 0.0, 0.623, -0.012, -0.914),
+    'male': (9.928, -0.083, -0.369, 0.0, 0.329, -0.014, -0.705)
+}
+
+CAD_MODEL = {
+    'female': (11.250, -0.095, -0.639, -0.244, 0.845, -0.013, -1.315),
+    'male': (9.081 + 0.329, -0.075, -0.579, -0.320, 1.082, -0.011, -0.729)
+}
+
+# Tabulated risk percentage 100 / (1 + exp(x)) for the optional fast scoring. With linear interpolation
+# the error is at most step^2 / 8 * max|f''| = 1.9e-5 percentage points. Risks that close to a rounding
+# boundary of 0.1 % can still round to the neighbouring value, see test_fast_scoring.py.
+SIGMOID_LIMIT = 16
+SIGMOID_STEP = 1 / 256
+SIGMOID_TABLE = 100 / (1 + np.exp(np.arange(-SIGMOID_LIMIT, SIGMOID_LIMIT + SIGMOID_STEP, SIGMOID_STEP)))
+
+
+def isFemale(gender):
+    """
+    Array of booleans from genders given either as FHIR gender strings or as numbers (1 = female)
+    """
+    gender = np.asarray(gender)
+    if gender.dtype.kind in 'USO':
+        return gender == 'female'
+    return gender.astype(bool)
+
+
+def linearPredictor(model, BP, HDL, ch, age, smoke, db, gender):
+    """
+    Calculating the exponent of the risk model for arrays of patients
+    """
+    male = model['male']
+    delta = [f - m for f, m in zip(model['female'], male)]
+    values = (age, smoke, ch, HDL, BP, db)
+
+    x = male[0] + sum(coefficient * value for coefficient, value in zip(male[1:], values) if coefficient)
+    x_female = delta[0] + sum(coefficient * value for coefficient, value in zip(delta[1:], values) if coefficient)
+    return x + isFemale(gender) * x_female
+
+
+def riskPercentage(x, fast=False):
+    """
+    Risk percentage 100 / (1 + exp(x)), either exact or from the tabulated sigmoid
+    """
+    if not fast:
+        return 100 / (1 + np.exp(x))
+
+    position = (np.clip(x, -SIGMOID_LIMIT, SIGMOID_LIMIT) + SIGMOID_LIMIT) / SIGMOID_STEP
+    index = np.minimum(position.astype(np.intp), len(SIGMOID_TABLE) - 2)
+    weight = position - index
+    return SIGMOID_TABLE[index] + weight * (SIGMOID_TABLE[index + 1] - SIGMOID_TABLE[index])
+
+
+def calculateRiskArrays(BP, HDL, ch, age, smoke, db, gender, fast=False):
+    """
+    Calculating the risks of many patients at once from arrays of the input values,
+    returns a dict of arrays shaped like the result struct
+    """
+    values = [np.asarray(value, dtype=float) for value in (BP, HDL, ch, age, smoke, db)]
+    HT = np.round(riskPercentage(linearPredictor(CAD_MODEL, *values, gender), fast), 1)
+    stroke = np.round(riskPercentage(linearPredictor(STROKE_MODEL, *values, gender), fast), 1)
+    both = np.round((1 - (1 - HT/100) * (1 - stroke/100)) * 100, 1)
+
+    return {'Heart attack': HT, 'Stroke': stroke, 'Both': both}
+
+
+# Fixed-width record of the binary cohort file, the fields are named after the patient struct.
+# Gender is 1 for female and 0 for male. The id has room for the 64 characters of a FHIR id.
+COHORT_DTYPE = np.dtype([
+    ('Id', 'S64'),
+    ('Age', 'u1'),
+    ('Gender', 'u1'),
+    ('Blood pressure', 'f4'),
+    ('Cholesterol', 'f4'),
+    ('HDL', 'f4'),
+    ('Smoke', 'u1'),
+    ('Diabetes', 'u1')
+])
+
+COHORT_MAGIC = b'FINRISK1'
+COHORT_HEADER_SIZE = 16
+
+
+def createCohort(path, size):
+    """
+    Create a binary cohort file of the given number of patients and return it as a writable memory map
+    """
+    with open(path, 'wb') as f:
+        f.write(COHORT_MAGIC + np.uint64(COHORT_DTYPE.itemsize).tobytes())
+    return np.memmap(path, dtype=COHORT_DTYPE, mode='r+', offset=COHORT_HEADER_SIZE, shape=(size,))
+
+
+def writeCohort(path, records):
+    """
+    Write patient structs (or a structured array of COHORT_DTYPE) into a binary cohort file
+    """
+    if not isinstance(records, np.ndarray):
+        for record in records:
+            if len(str(record['Id']).encode('utf-8')) > COHORT_DTYPE['Id'].itemsize:
+                raise ValueError('Patient id does not fit in the cohort file: ' + str(record['Id']))
+        records = np.array([(record['Id'], record['Age'], record['Gender'] == 'female',
+                             record['Blood pressure'], record['Cholesterol'], record['HDL'],
+                             record['Smoke'], record['Diabetes']) for record in records],
+                           dtype=COHORT_DTYPE)
+
+    cohort = createCohort(path, len(records))
+    cohort[:] = records
+    cohort.flush()
+    return cohort
+
+
+def openCohort(path):
+    """
+    Open a binary cohort file as a read-only memory map. Nothing is read before the columns are used,
+    and processes opening the same file share the pages of the mapping.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(COHORT_HEADER_SIZE)
+    if header[:8] != COHORT_MAGIC or np.frombuffer(header[8:], np.uint64)[0] != COHORT_DTYPE.itemsize:
+        raise ValueError('Not a cohort file: ' + path)
+
+    return np.memmap(path, dtype=COHORT_DTYPE, mode='r', offset=COHORT_HEADER_SIZE)
+
+
+def applyScenario(cohort, scenario=None):
+    """
+    Apply a what-if scenario to the cohort columns, e.g. {'Smoke': ('set', 0), 'Blood pressure': ('add', -10)}.
+    The base data is not copied or changed: unchanged columns are views of the memory map
+    and only the changed columns are new float arrays, so that the small integer columns do not overflow.
+    """
+    columns = {name: cohort[name] for name in COHORT_DTYPE.names if name != 'Id'}
+
+    for name, (operation, value) in (scenario or {}).items():
+        if operation == 'set':
+            columns[name] = np.full(len(cohort), value, dtype=np.float32)
+        elif operation == 'add':
+            columns[name] = columns[name].astype(np.float32) + value
+        elif operation == 'scale':
+            columns[name] = columns[name].astype(np.float32) * value
+        else:
+            raise ValueError('Unknown scenario operation: ' + str(operation))
+
+    return columns
+
+
+def validateCohort(cohort):
+    """
+    Error masks of the cohort rows, see validateInputs
+    """
+    return validateInputs({key: cohort[key] for key in VALID_RANGES})
+
+
+def scoreCohort(cohort, scenario=None, fast=False, chunk_size=1000000):
+    """
+    Calculating the risks of the whole cohort with an optional what-if scenario,
+    in chunks so that the temporary arrays stay small
+    """
+    risks = {key: np.empty(len(cohort), dtype=np.float32) for key in RISK_KEYS}
+
+    for start in range(0, len(cohort), chunk_size):
+        chunk = applyScenario(cohort[start:start + chunk_size], scenario)
+        chunk_risks = calculateRiskArrays(chunk['Blood pressure'], chunk['HDL'], chunk['Cholesterol'],
+                                          chunk['Age'], chunk['Smoke'], chunk['Diabetes'], chunk['Gender'], fast)
+        for key in risks:
+            risks[key][start:start + chunk_size] = chunk_risks[key]
+
+    return risks
+
+
+# Lower limits of the age bands of the population analytics
+AGE_BANDS = (0, 35, 45, 55, 65, 75)
+
+# The risks are rounded to 0.1 %, so histograms of 0.1 % bins give exact counts and quantiles
+RISK_BINS = 1001
+
+
+def ageBandName(band):
+    if band == len(AGE_BANDS) - 1:
+        return '{}+'.format(AGE_BANDS[band])
+    return '{}-{}'.format(AGE_BANDS[band], AGE_BANDS[band + 1] - 1)
+
+
+class PopulationSketch(object):
+    """
+    Fixed-bin histograms of the risks by age band and sex. The memory used does not depend on the
+    size of the population, and the sketches of different workers are combined with merge.
+    """
+    KEYS = RISK_KEYS
+
+    def __init__(self, counts=None):
+        if counts is None:
+            counts = np.zeros((len(AGE_BANDS), 2, len(self.KEYS), RISK_BINS), dtype=np.int64)
+        self.counts = counts
+
+    def add(self, age, gender, risks):
+        """
+        Add a batch of scored patients, risks is a dict of arrays like the one from scoreCohort
+        """
+        band = np.maximum(np.searchsorted(AGE_BANDS, np.asarray(age), side='right') - 1, 0)
+        group = band * 2 + isFemale(gender)
+
+        for k, key in enumerate(self.KEYS):
+            bins = np.clip(np.rint(np.asarray(risks[key]) * 10).astype(np.intp), 0, RISK_BINS - 1)
+            index = (group * len(self.KEYS) + k) * RISK_BINS + bins
+            self.counts += np.bincount(index, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def save(self, path):
+        np.save(path, self.counts)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+    def histogram(self, key, band=None, gender=None):
+        """
+        Counts of the 0.1 % risk bins of the given age band and gender ('female' or 'male'),
+        None selects all of them
+        """
+        counts = self.counts[:, :, self.KEYS.index(key), :]
+        if band is not None:
+            counts = counts[band:band + 1]
+        if gender is not None:
+            sex = 1 if gender == 'female' else 0
+            counts = counts[:, sex:sex + 1]
+        return counts.sum(axis=(0, 1))
+
+    def count(self, key, band=None, gender=None):
+        return int(self.histogram(key, band, gender).sum())
+
+    def mean(self, key, band=None, gender=None):
+        counts = self.histogram(key, band, gender)
+        total = counts.sum()
+        return float(counts @ (np.arange(RISK_BINS) / 10) / total) if total else 0.0
+
+    def quantile(self, key, q, band=None, gender=None):
+        counts = np.cumsum(self.histogram(key, band, gender))
+        if counts[-1] == 0:
+            return 0.0
+        return float(np.searchsorted(counts, q * counts[-1]) / 10)
+
+    def countAbove(self, key, threshold, band=None, gender=None):
+        counts = self.histogram(key, band, gender)
+        return int(counts[int(round(threshold * 10)) + 1:].sum())
+
+    def percentile(self, key, risk, band=None, gender=None):
+        """
+        Percentage of the population with a lower risk than the given one
+        """
+        counts = self.histogram(key, band, gender)
+        total = counts.sum()
+        return float(counts[:int(round(risk * 10))].sum() / total * 100) if total else 0.0
+
+
+def sketchCohortPart(path, start, stop):
+    cohort = openCohort(path)[start:stop]
+    cohort = cohort[~validateCohort(cohort)['Any']]
+    sketch = PopulationSketch()
+    sketch.add(cohort['Age'], cohort['Gender'], scoreCohort(cohort))
+    return sketch.counts
+
+
+def sketchCohort(path, workers=1, part_size=1000000):
+    """
+    Score a cohort file and collect the population sketch, in parallel parts when workers > 1
+    """
+    size = len(openCohort(path))
+    parts = [(path, start, min(start + part_size, size)) for start in range(0, size, part_size)]
+    sketch = PopulationSketch()
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            for counts in executor.map(sketchCohortPart, *zip(*parts)):
+                sketch.merge(PopulationSketch(counts))
+    else:
+        for part in parts:
+            sketch.merge(PopulationSketch(sketchCohortPart(*part)))
+    return sketch
+
+
+def barCoords(value, i):
+    """
+    Corners of the i:th bar of the histogram for the risk percentage
+    """
+    x0 = 100 + i * 95
+    y0 = (250 - round(250*(value/100)))+25
+    return x0, y0, x0 + 60, 275
+
+
+def histogramLayout(data, bar_color="#90B2DF"):
+    """
+    The items of the risk histogram as (kind, coordinates, options) tuples, where kind is the
+    name of the Tk canvas create method. Items with tags change with the data, the rest are the same
+    for every patient.
+    """
+    font = ("Helvetica", 11)
+    items = []
+
+    for y in range(25, 300, 25):
+        items.append(('line', (40, y, 400, y), {}))
+    items.append(('line', (50, 15, 50, 275), {}))
+
+    for i, key in enumerate(data.keys()):
+        items.append(('rectangle', barCoords(data[key], i), {'fill': bar_color, 'tags': "bar{}".format(i)}))
+
+    for i, (key, x_label, x_value) in enumerate((('Heart attack', 130, 130), ('Stroke', 225, 227), ('Both', 320, 323))):
+        items.append(('text', (x_label, 285), {'text': key, 'fill': "black", 'font': font}))
+        items.append(('text', (x_value, 295), {'text': "{} %".format(data[key]), 'fill': "#4C70AB",
+                                               'font': font, 'tags': "value{}".format(i)}))
+
+    for y in range(25, 300, 25):
+        items.append(('text', (25, y), {'text': str((275 - y) * 10 // 25),
+                                        'fill': "black", 'font': font}))
+
+    return items
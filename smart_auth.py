@@ -0,0 +1,141 @@
+"""
+SMART Backend Services authorization for SimpleFHIRClient.
+The client signs a JWT with its private key and exchanges it for an access token with the
+client credentials flow. The token is cached in memory (and optionally on disk) and refreshed
+before it expires, so the authorization costs about one request per token lifetime.
+Signing the JWT needs the PyJWT and cryptography packages.
+
+Usage:
+    auth = SMARTBackendAuth(token_url, client_id, open('private_key.pem').read(), key_id)
+    client = SimpleFHIRClient(server_url, '', '', auth=auth)
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
+
+
+class SMARTBackendAuth(requests.auth.AuthBase):
+    """
+    requests authentication that adds a cached SMART Backend Services access token to the requests
+    """
+    def __init__(self, token_url, client_id, private_key, key_id=None, scope='system/*.read',
+                 algorithm='RS384', cache_path=None, refresh_margin=60):
+        if jwt is None:
+            raise ImportError('SMART Backend Services needs the PyJWT package (pip install pyjwt cryptography)')
+
+        self.token_url = token_url
+        self.client_id = client_id
+        self.private_key = private_key
+        self.key_id = key_id
+        self.scope = scope
+        self.algorithm = algorithm
+        self.cache_path = cache_path
+        # the token is refreshed this many seconds before it expires, at most half of its lifetime
+        self.refresh_margin = refresh_margin
+
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.access_token = None
+        self.expires_at = 0
+        self.margin = refresh_margin
+        self.loadCache()
+
+    def __call__(self, request):
+        request.headers['Authorization'] = 'Bearer ' + self.token()
+        request.register_hook('response', self.retryUnauthorized)
+        return request
+
+    def token(self):
+        """
+        The current access token, refreshed first if it is about to expire.
+        Only one of the concurrent callers refreshes, the others wait for its token.
+        """
+        if self.access_token is not None and time.time() < self.expires_at - self.margin:
+            return self.access_token
+
+        with self.lock:
+            if self.access_token is None or time.time() >= self.expires_at - self.margin:
+                self.refresh()
+            return self.access_token
+
+    def refresh(self):
+        now = int(time.time())
+        assertion = jwt.encode({
+            'iss': self.client_id,
+            'sub': self.client_id,
+            'aud': self.token_url,
+            'exp': now + 300,
+            'jti': str(uuid.uuid4())
+        }, self.private_key, algorithm=self.algorithm, headers={'kid': self.key_id} if self.key_id else None)
+
+        response = self.session.post(self.token_url, data={
+            'grant_type': 'client_credentials',
+            'scope': self.scope,
+            'client_assertion_type': 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
+            'client_assertion': assertion
+        })
+        response.raise_for_status()
+        token = response.json()
+
+        lifetime = int(token.get('expires_in', 300))
+        self.access_token = token['access_token']
+        self.expires_at = now + lifetime
+        # with short lived tokens the margin would cover the whole lifetime and every request would refresh
+        self.margin = min(self.refresh_margin, lifetime / 2)
+        self.saveCache()
+
+    def retryUnauthorized(self, response, **kwargs):
+        """
+        If the server rejects the token before its expiry time, get a new token and send the request again
+        """
+        if response.status_code != 401 or getattr(response.request, 'retried_auth', False):
+            return response
+
+        rejected = response.request.headers.get('Authorization')
+        with self.lock:
+            if rejected == 'Bearer ' + str(self.access_token):
+                self.refresh()
+
+        request = response.request.copy()
+        request.headers['Authorization'] = 'Bearer ' + self.token()
+        request.retried_auth = True
+        # the body is read so that the connection can be reused
+        response.content
+        response.close()
+        retried = response.connection.send(request, **kwargs)
+        retried.history.append(response)
+        return retried
+
+    def loadCache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return
+        if token.get('token_url') == self.token_url and token.get('client_id') == self.client_id:
+            self.access_token = token['access_token']
+            self.expires_at = token['expires_at']
+            self.margin = token.get('margin', self.refresh_margin)
+
+    def saveCache(self):
+        if self.cache_path is None:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        # the token is a secret, so only the owner can read the file
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({'token_url': self.token_url, 'client_id': self.client_id,
+                       'access_token': self.access_token, 'expires_at': self.expires_at,
+                       'margin': self.margin}, f)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,83 @@
+"""
+Comparison of the fast tabulated sigmoid against the exact risk calculation.
+The grid covers every whole age, whole blood pressure and every 0.1 step of HDL and cholesterol
+within VALID_RANGES (age from 18) for all the smoke, diabetes and gender combinations.
+The grid has about 3.5 billion risk values and takes a few minutes, so it only runs when
+the EXHAUSTIVE environment variable is set. The other tests are quick.
+
+Usage: python -m pytest test_fast_scoring.py
+       EXHAUSTIVE=1 python -m pytest test_fast_scoring.py
+"""
+
+import os
+import unittest
+
+import numpy as np
+
+from risk_scoring import (CAD_MODEL, STROKE_MODEL, SIGMOID_LIMIT, SIGMOID_STEP, VALID_RANGES,
+                          calculateRiskArrays, linearPredictor, riskPercentage)
+
+# Largest allowed difference of the unrounded risk percentages
+MAX_ERROR = SIGMOID_STEP ** 2 / 8 * 100 * 0.0963 + 100 / (1 + np.exp(SIGMOID_LIMIT))
+
+
+def grid(key, step):
+    low, high = VALID_RANGES[key]
+    return np.round(np.arange(low, high + step / 2, step), 1)
+
+
+class FastScoringTest(unittest.TestCase):
+
+    def test_sigmoid_table(self):
+        x = np.linspace(-2 * SIGMOID_LIMIT, 2 * SIGMOID_LIMIT, 2000001)
+        error = np.abs(riskPercentage(x, fast=True) - riskPercentage(x))
+        self.assertLessEqual(error.max(), MAX_ERROR)
+
+    @unittest.skipUnless(os.environ.get('EXHAUSTIVE'), 'set EXHAUSTIVE=1 to run the whole grid')
+    def test_exhaustive_grid(self):
+        BP, HDL, ch = np.meshgrid(grid('Blood pressure', 1), grid('HDL', 0.1), grid('Cholesterol', 0.1),
+                                  indexing='ij')
+        BP, HDL, ch = BP.ravel(), HDL.ravel(), ch.ravel()
+        worst = 0
+        mismatches = 0
+        values = 0
+
+        for age in range(18, VALID_RANGES['Age'][1] + 1):
+            for smoke in (0, 1):
+                for db in (0, 1):
+                    for gender in ('male', 'female'):
+                        rounded = {}
+                        for key, model in (('Heart attack', CAD_MODEL), ('Stroke', STROKE_MODEL)):
+                            x = linearPredictor(model, BP, HDL, ch, age, smoke, db, gender)
+                            fast, exact = riskPercentage(x, fast=True), riskPercentage(x)
+                            worst = max(worst, np.abs(fast - exact).max())
+                            rounded[key] = np.round(fast, 1), np.round(exact, 1)
+
+                        # the risks used by calculateRiskArrays, calculated from the same exponents
+                        (HT_fast, HT), (stroke_fast, stroke) = rounded['Heart attack'], rounded['Stroke']
+                        rounded['Both'] = (np.round((1 - (1 - HT_fast/100) * (1 - stroke_fast/100)) * 100, 1),
+                                           np.round((1 - (1 - HT/100) * (1 - stroke/100)) * 100, 1))
+
+                        for key, (fast, exact) in rounded.items():
+                            difference = np.abs(fast - exact)
+                            # the fast value can only round to the neighbouring 0.1 %, Both is calculated
+                            # from the two rounded risks, so it can move by one step of each
+                            self.assertLessEqual(difference.max(), (0.2 if key == 'Both' else 0.1) + 1e-9)
+                            mismatches += np.count_nonzero(difference > 1e-9)
+                            values += len(BP)
+
+        self.assertLessEqual(worst, MAX_ERROR)
+        # a rounded value can only differ when the exact risk is within MAX_ERROR of a rounding boundary
+        self.assertLess(mismatches, values * 2 * MAX_ERROR / 0.1)
+
+    def test_calculate_risk_arrays(self):
+        fast = calculateRiskArrays([140, 120], [1.2, 1.5], [5.5, 4.0], [60, 45], [1, 0], [0, 1],
+                                   ['male', 'female'], fast=True)
+        exact = calculateRiskArrays([140, 120], [1.2, 1.5], [5.5, 4.0], [60, 45], [1, 0], [0, 1],
+                                    ['male', 'female'])
+        for key in exact:
+            np.testing.assert_allclose(fast[key], exact[key], atol=0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()